@@ -1,49 +1,73 @@
+from itertools import groupby
+from operator import attrgetter
+
 from django.conf import settings
 from django.contrib import admin
-from django.contrib.admin.widgets import AdminURLFieldWidget
-from django.db import models
+from django.db import transaction
 from django.db.models import F, Q
 from django.db.models.functions import Length
 from django.utils.html import format_html
-from django.utils.safestring import mark_safe
 from scrapyd_api import ScrapydAPI
 
-from .models import Author, Category, CookingStep, Recipe
-from .utils import translate_text
+from . import search
+from .content import join_descriptions, merge_smilies
+from .jobs import queued_action
+from .models import (Author, Category, CookingStep, CrawlState, Job, Recipe,
+                     TranslationMemory)
+from .signals import deferred_recipe_status
+from .translation import get_translation_service, translate_objects
 
 scrapyd = ScrapydAPI(settings.SCRAPY_ADDRESS)
 
-# TODO: extract smilies from the ccoking steps
-
 
-def extract_smilies(modeladmin, request, queryset):
+@queued_action(Recipe)
+def extract_smilies(queryset, batch_size=500):
     '''
-    Admin Action - Recipe
+    Admin Action - Recipe (runs in the job queue, see recipes.jobs)
     Extract cooking steps which have imoji as their image and add description to previous step.
-    '''
-    for recipe in queryset:
-        smilies_steps = recipe.steps.filter(Q(image__icontains='smiles')
-                                            | Q(image__icontains='emoticon')
-                                            | Q(image__icontains='cheesebuerger.de/')).order_by('-order')
-        # print("count is %d" % (smilies_steps.count()))
-        for step in smilies_steps:
-            # Get previous step
-            pre_index = step.order - 1
-            if pre_index > 0:
-                pre = CookingStep.objects.get(
-                    recipe=recipe, order=pre_index)
-                # Add description_fa &_en to previous step
-                pre.description_fa = pre.description_fa + " " + step.description_fa
-                pre.description_en = pre.description_en + " " + step.description_en
-                pre.save()
-                # Remove the step
-                step.delete()
-
-        # Reorder steps
-        steps = recipe.steps.all().order_by('order')
-        for order, step in enumerate(steps, start=1):
-            step.order = order
-            step.save()
+    The steps of each batch of recipes are merged and renumbered in memory,
+    then saved with one bulk update and one delete in a transaction.
+    '''
+    recipe_ids = list(queryset.order_by('pk').values_list('pk', flat=True))
+    merged = 0
+    for start in range(0, len(recipe_ids), batch_size):
+        steps = CookingStep.objects.filter(
+            recipe__in=recipe_ids[start:start + batch_size]).order_by('recipe', 'order')
+        changed, moved, removed = [], [], []
+        for recipe_id, recipe_steps in groupby(steps, key=attrgetter('recipe_id')):
+            recipe_steps = list(recipe_steps)
+            groups = merge_smilies([step.image for step in recipe_steps])
+            for order, group in enumerate(groups, start=1):
+                step = recipe_steps[group[0]]
+                smilies = [recipe_steps[index] for index in group[1:]]
+                if smilies:
+                    for field in ('description_fa', 'description_en'):
+                        setattr(step, field, join_descriptions(
+                            getattr(other, field) for other in [step] + smilies))
+                    changed.append(step)
+                    removed += [smiley.pk for smiley in smilies]
+                if step.order != order:
+                    moved.append((order, step))
+        if not (changed or moved):
+            continue
+        with transaction.atomic(), deferred_recipe_status():
+            CookingStep.objects.filter(pk__in=removed).delete()
+            # Move the steps through negative orders, as (recipe, order) is unique
+            for order, step in moved:
+                step.order = -step.pk
+            CookingStep.objects.bulk_update([step for order, step in moved], ['order'])
+            for order, step in moved:
+                step.order = order
+            updated = {step.pk: step for step in changed}
+            updated.update((step.pk, step) for order, step in moved)
+            CookingStep.objects.bulk_update(
+                updated.values(), ['order', 'description_fa', 'description_en'])
+            # bulk_update() sends no signals
+            search.reindex(changed)
+            Recipe.update_status({step.recipe_id for step in changed + [
+                step for order, step in moved]})
+        merged += len(removed)
+    return '%d smilies are merged into their previous steps.' % merged
 
 
 def update_recipes(modeladmin, request, queryset):
@@ -57,58 +81,77 @@ def update_recipes(modeladmin, request, queryset):
 
 def modify_blank_steps_of_translated_recipes(modeladmin, request, queryset):
     '''
-    Admin Action - Recipe
+    Admin Action - Recipe, Cooking step
     Modify all translated recipes' cooking steps with no english description
     to a prefabricated description.
+    The steps are changed with one UPDATE, which sends no signals, so their
+    search terms and the status of their recipes are updated here.
     '''
     prefabricated_description = 'A picture is worth a thousand words! :D'
-    translated_steps = queryset.select_related().filter(
-        recipe__translated=True, description_en='-'
-    ).update(description_en=prefabricated_description)
+    steps = queryset
+    if queryset.model is Recipe:
+        steps = CookingStep.objects.filter(recipe__in=queryset)
+    steps = list(steps.filter(recipe__translated=True, description_en='-').only(
+        'recipe', 'description_fa'))
+    if not steps:
+        return
+    with transaction.atomic():
+        CookingStep.objects.filter(pk__in=[step.pk for step in steps]).update(
+            description_en=prefabricated_description)
+        for step in steps:
+            step.description_en = prefabricated_description
+        search.reindex(steps)
+        Recipe.update_status({step.recipe_id for step in steps})
+
+
+@queued_action(Recipe)
+def update_translated_state(queryset):
+    '''
+    Admin Action - Recipe (runs in the job queue, see recipes.jobs)
+    Check the Recipe, if the title and all cooking steps are translated,
+    then update the translated state to True.
+    '''
+    # Translated steps: translated or empty cooking steps, see UNTRANSLATED_STEP
+    count = queryset.update_translated_state()
+    return '%d recipes are marked as translated.' % count
 
 
-def update_translated_state(modeladmin, request, queryset):
+def translate_and_report(queryset, source_field, target_field):
     '''
-    Admin Action - Recipe
-    Check the Recipe, if the title and all cooking steps are translated,
-    then update the translated state to True.
+    Translate the objects in batches (saved with bulk_update), returns a report
+    with the hit rate of the translation memory.
     '''
-    # Find translated steps: transalted or empty cooking steps
-    ok_steps = CookingStep.objects.filter(
-        ~Q(description_en='') | Q(description_fa__in=['', '-']))
-    queryset = queryset.prefetch_related('steps').filter(translated=False)
-    for item in queryset:
-        if set(item.steps.all()).issubset(set(ok_steps)):  # Check if all the steps are translated
-            if item.title_en != "":
-                item.translated = True
-                item.save()
+    service = get_translation_service()
+    hits, misses = service.hits, service.misses
+    count = translate_objects(queryset, source_field, target_field)
+    hits, misses = service.hits - hits, service.misses - misses
+    return ('%d items are translated, %d of %d distinct texts are found in the '
+            'translation memory (hit rate: %.0f%%).' % (
+                count, hits, hits + misses,
+                100.0 * hits / (hits + misses) if hits + misses else 0))
 
 
-def translate_recipe_title(modeladmin, request, queryset):
+@queued_action(Recipe)
+def translate_recipe_title(queryset):
     '''
-    Admin Action - Recipe
+    Admin Action - Recipe (runs in the job queue, see recipes.jobs)
     Translates title of recipes
     '''
     # check if it needs translation or not
-    queryset = queryset.filter(title_en__in=['', '-', None])
-    # get the translated text and update the item
-    for item in queryset:
-        item.title_en = translate_text('en', item.title_fa)
-        item.save()
+    queryset = queryset.filter(Q(title_en__in=['', '-']) | Q(title_en=None))
+    return translate_and_report(queryset, 'title_fa', 'title_en')
 
 
-def translate_cooking_step(modeladmin, request, queryset):
+@queued_action(CookingStep)
+def translate_cooking_step(queryset):
     '''
-    Admin Action - Cooking step
+    Admin Action - Cooking step (runs in the job queue, see recipes.jobs)
     Translates cooking steps of untranslated cooking steps
     '''
     # check if it needs translation or not
-    queryset = queryset.select_related().filter(
+    queryset = queryset.filter(
         recipe__translated=False, description_en__in=['', '-'])
-    # get the translated text and update the item
-    for item in queryset:
-        item.description_en = translate_text('en', item.description_fa)
-        item.save()
+    return translate_and_report(queryset, 'description_fa', 'description_en')
 
 
 class RecipeEnglishTitleAvailableFilter(admin.SimpleListFilter):
@@ -152,23 +195,11 @@ class IsManuallyTranslatableFilter(admin.SimpleListFilter):
         )
 
     def queryset(self, request, queryset):
-        ok_steps = CookingStep.objects.filter(
-            Q(description_fa__contains='teaspoon')
-            |
-            Q(description_fa__contains='tsp')
-            |
-            Q(description_fa__contains='tbsp')
-            |
-            Q(description_fa__contains='tablespoon')
-            |
-            Q(description_fa__contains='gr')
-            |
-            Q(description_fa__contains='cup')
-        )
+        # See Recipe.update_status
         if self.value() == '1':
-            return queryset.filter(steps__in=ok_steps, translated=False)
+            return queryset.filter(manually_translatable=True, translated=False)
         if self.value() == '0':
-            return queryset.filter(Q(translated=False) & ~Q(steps__in=ok_steps))
+            return queryset.filter(manually_translatable=False, translated=False)
         return queryset
 
 
@@ -184,12 +215,9 @@ class RecipesWithSmiliesFilter(admin.SimpleListFilter):
         )
 
     def queryset(self, request, queryset):
-        smilies_steps = CookingStep.objects.filter(
-            Q(image__icontains='smiles')
-            | Q(image__icontains='emoticon')
-            | Q(image__icontains='cheesebuerger.de/')).order_by('-order')
+        # See Recipe.update_status
         if self.value() == '1':
-            return queryset.prefetch_related('steps').filter(steps__in=smilies_steps).distinct()
+            return queryset.filter(has_smilies=True)
         # if self.value() == '0':
         #     return queryset
         return queryset
@@ -211,7 +239,7 @@ class IsGoogleTranslatableCookingStepFilter(admin.SimpleListFilter):
 
     def queryset(self, request, queryset):
         if self.value() == '1':
-            return queryset.select_related('recipe').filter(Q(recipe__translated=False, description_en="") & ~Q(description_fa__in=['', '-']))
+            return queryset.select_related('recipe').filter(recipe__translated=False, description_en="", is_empty=False)
         if self.value() == '0':
             return queryset.select_related('recipe').filter(Q(recipe__translated=True) | ~Q(description_en=""))
 
@@ -234,9 +262,9 @@ class EmptyCookingStepFilter(admin.SimpleListFilter):
 
     def queryset(self, request, queryset):
         if self.value() == '1':
-            return queryset.filter(description_fa__in=['', '-', None])
+            return queryset.filter(is_empty=True)
         elif self.value() == '0':
-            return queryset.filter(~Q(description_fa='') & ~Q(description_fa='-'))
+            return queryset.filter(is_empty=False)
         return queryset
 
 
@@ -262,36 +290,17 @@ class TranslatedCookingStepFilter(admin.SimpleListFilter):
         return queryset
 
 
-class AdminImageURLWidget(AdminURLFieldWidget):
-    '''
-    Admin widget - thumbnail image - Recipe
-    This will customize Image widget for showing some thumbnail image preview
-    for each image. This class is a custom class for showing image of each cooking
-    step in tabular inline section in each Recipe object.
-    As you know I consider image field as URLField, not ImageField, as mention the
-    reason in corresponding model description.
-    '''
-
-    def render(self, name, value, attrs=None, renderer=None):
-        output = []
-        # As a simple URLField is used for keeping image urls, the value
-        # contains the url.
-        # NOTE: Update the following line when URLField replaced with ImageField:
-        # if value and getattr(value,"url", None):
-        #   image_url = value.url
-        if value:
-            image_url = value
-            file_name = str(value)
-            # NOTE: The width of images can be modified by "image_width"
-            image_width = 100
-            output.append(
-                u'<a href="%s" target="_blank">'
-                '<img src="%s" width="%d" alt="%s" />'
-                '</a>' % (image_url, image_url, image_width, file_name)
-            )
-        output.append(super(AdminURLFieldWidget, self).render(
-            name, value, attrs, renderer))
-        return mark_safe(u''.join(output))
+def step_thumbnail(step, width, size='small'):
+    '''
+    Thumbnail of the step image. The downloaded thumbnail is used if it is
+    available (see CookingStep.get_image_url), so the admin pages do not load
+    the full size images from the original site.
+    '''
+    url = step.get_image_url(size)
+    if not url:
+        return ''
+    return format_html("<a href='{}' target='_blank'><img src='{}' width='{}' /></a>",
+                       step.get_image_url(), url, width)
 
 
 class CookingStepInline(admin.TabularInline):
@@ -299,7 +308,7 @@ class CookingStepInline(admin.TabularInline):
     Inline view for Recipe
     Tabular Inline View for cooking steps of a recipe.
     Ordering of steps are due the "order" field.
-    It will show a image thumbnail of each step using AdminImageWidget class.
+    It will show a image thumbnail of each step (see step_thumbnail).
     '''
 
     model = CookingStep
@@ -307,9 +316,13 @@ class CookingStepInline(admin.TabularInline):
     max_num = 20
     extra = 0
     ordering = ['order']
-    fields = ['image', 'description_fa', 'description_en', 'order']
-    formfield_overrides = {
-        models.URLField: {'widget': AdminImageURLWidget}}
+    fields = ['get_thumb', 'image', 'description_fa', 'description_en', 'order']
+    readonly_fields = ['get_thumb']
+
+    def get_thumb(self, obj):
+        return step_thumbnail(obj, 100)
+
+    get_thumb.short_description = 'Thumb'
 
 
 class RecipeAdmin(admin.ModelAdmin):
@@ -329,7 +342,8 @@ class RecipeAdmin(admin.ModelAdmin):
                     'alternate_link',
                     'published_date',
                     'author',
-                    'translated']
+                    'translated',
+                    'untranslated_step_count']
 
     search_fields = ['title_fa',
                      'title_en',
@@ -390,7 +404,7 @@ class CookingStepAdmin(admin.ModelAdmin):
 
     # NOTE: the width of the thumbnail image can be modified with width attribute
     def get_thumb(self, obj):
-        return format_html("<img src='{}'  width='45' />".format(obj.image))
+        return step_thumbnail(obj, 45)
 
     get_thumb.allow_tags = True
     get_thumb.__name__ = 'Thumb'
@@ -402,8 +416,9 @@ class CategoryAdmin(admin.ModelAdmin):
     It is a simple table .
     TODO: I may add some inline fprms for related recipes of each category.
     '''
-    list_display = ['title_fa', 'title_en']
+    list_display = ['title_fa', 'title_en', 'recipe_count']
     search_fields = ['title_fa', 'title_en']
+    readonly_fields = ['recipe_count']
 
 
 class AuthorAdmin(admin.ModelAdmin):
@@ -416,7 +431,57 @@ class AuthorAdmin(admin.ModelAdmin):
     search_fields = ['title_fa', 'title_en', 'email', 'website']
 
 
+class CrawlStateAdmin(admin.ModelAdmin):
+    '''
+    Watermarks of the spiders. Delete a watermark to make the next crawl of
+    the spider a full crawl.
+    '''
+    list_display = ['spider', 'watermark', 'finished_date']
+
+
+class TranslationMemoryAdmin(admin.ModelAdmin):
+    '''
+    Translations which are reused instead of calling the translation API.
+    A wrong translation can be fixed here, or deleted to be translated again.
+    '''
+    list_display = ['source_text', 'translation', 'target', 'hits', 'created_date']
+    list_filter = ['target']
+    search_fields = ['source_text', 'translation']
+    readonly_fields = ['key', 'source_text', 'target', 'hits', 'created_date']
+
+
+def requeue_jobs(modeladmin, request, queryset):
+    '''
+    Admin Action - Job
+    Run the failed (or stuck) jobs again.
+    '''
+    count = queryset.exclude(status=Job.DONE).update(
+        status=Job.PENDING, error='', started_date=None, heartbeat_date=None,
+        finished_date=None)
+    modeladmin.message_user(request, '%d jobs are queued again.' % count)
+
+
+class JobAdmin(admin.ModelAdmin):
+    '''
+    Jobs of the queued admin actions (see recipes.jobs), they are run by
+    "python manage.py run_jobs". Filter by group to see the progress of one
+    run of an action.
+    '''
+    list_display = ['__str__', 'task', 'status', 'object_count', 'result',
+                    'created_date', 'started_date', 'heartbeat_date', 'finished_date',
+                    'group']
+    list_filter = ['status', 'task']
+    search_fields = ['group']
+    readonly_fields = ['task', 'group', 'object_ids', 'object_count', 'status',
+                       'result', 'error', 'created_date', 'started_date',
+                       'heartbeat_date', 'finished_date']
+    actions = [requeue_jobs]
+
+
 admin.site.register(Author, AuthorAdmin)
 admin.site.register(Category, CategoryAdmin)
 admin.site.register(Recipe, RecipeAdmin)
 admin.site.register(CookingStep, CookingStepAdmin)
+admin.site.register(CrawlState, CrawlStateAdmin)
+admin.site.register(TranslationMemory, TranslationMemoryAdmin)
+admin.site.register(Job, JobAdmin)
@@ -2,4 +2,7 @@ from django.apps import AppConfig
 
 
 class RecipesConfig(AppConfig):
-    name = 'Recipes'
+    name = 'recipes'
+
+    def ready(self):
+        from . import signals  # noqa: F401
@@ -0,0 +1,323 @@
+'''
+Benchmarks on a synthetic catalogue, run them by:
+    python manage.py benchmark <name> --recipes 50000
+They run on a throwaway test database (the same way the test runner does),
+so the real data is never touched.
+'''
+import random
+import re
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.db.models import Q
+from django.test.utils import (CaptureQueriesContext, setup_test_environment,
+                               teardown_test_environment)
+from django.utils import timezone
+
+from .content import extract_steps
+from .export import export_recipes
+from .load import RecipeLoader
+from .models import Author, Category, CookingStep, Recipe
+
+BENCHMARKS = {}
+
+
+def benchmark(func):
+    BENCHMARKS[func.__name__] = func
+    return func
+
+
+@contextmanager
+def benchmark_database():
+    old_name = connection.settings_dict['NAME']
+    setup_test_environment()
+    connection.creation.create_test_db(verbosity=0, autoclobber=True,
+                                       serialize=False)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+
+def migrate(target):
+    '''
+    Migrates the database to target and returns the apps of its state.
+    '''
+    executor = MigrationExecutor(connection)
+    executor.migrate([target])
+    return executor.loader.project_state(target).apps
+
+
+def measure(func, repeat=1):
+    '''
+    Returns the average run time of func in milliseconds.
+    '''
+    start = time.perf_counter()
+    for i in range(repeat):
+        func()
+    return (time.perf_counter() - start) * 1000 / repeat
+
+
+def create_catalogue(recipes=50000, steps=5, categories=40, batch_size=2000,
+                     step_factory=None):
+    '''
+    Fill the database with a synthetic catalogue: one author, some categories
+    and recipes which have "steps" cooking steps and 2 categories each.
+    step_factory(recipe_index, order) can return extra or other CookingStep fields.
+    '''
+    author = Author.objects.create(title_fa='طیبه', title_en='Tayebeh')
+    Category.objects.bulk_create([
+        Category(title_fa='دسته %d' % i, title_en='Category %d' % i)
+        for i in range(categories)])
+    category_ids = list(Category.objects.values_list('pk', flat=True))
+    now = timezone.now()
+    RecipeCategory = Recipe.categories.through
+    for start in range(0, recipes, batch_size):
+        batch = Recipe.objects.bulk_create([
+            Recipe(origin_id=str(i), title_fa='غذای %d' % i, title_en='',
+                   author=author, crowled_date=now,
+                   published_date=now - timedelta(minutes=i))
+            for i in range(start, min(start + batch_size, recipes))])
+        if connection.features.can_return_rows_from_bulk_insert:
+            recipe_ids = [recipe.pk for recipe in batch]
+        else:
+            recipe_ids = list(Recipe.objects.filter(
+                origin_id__in=[recipe.origin_id for recipe in batch]
+            ).order_by('pk').values_list('pk', flat=True))
+        CookingStep.objects.bulk_create([
+            CookingStep(recipe_id=recipe_id, order=order, **dict(
+                {'image': 'http://example.com/%d/%d.jpg' % (recipe_id, order),
+                 'description_fa': 'مرحله %d' % order, 'description_en': ''},
+                **(step_factory(index, order) if step_factory else {})))
+            for index, recipe_id in enumerate(recipe_ids, start=start)
+            for order in range(1, steps + 1)])
+        RecipeCategory.objects.bulk_create([
+            RecipeCategory(recipe_id=recipe_id, category_id=category_id)
+            for recipe_id in recipe_ids
+            for category_id in random.sample(category_ids, 2)])
+    Category.update_recipe_count()
+
+
+@benchmark
+def indexes(stdout, recipes=50000, steps=5, lookups=500, **options):
+    '''
+    Lookups of RecipesPipeline and the list endpoints, before and after the
+    indexes of migration 0010_lookup_indexes.
+    '''
+    create_catalogue(recipes, steps)
+    lookups = min(lookups, recipes)
+    origin_ids = random.sample(range(recipes), lookups)
+    recipe_ids = list(Recipe.objects.values_list('pk', flat=True)[:lookups])
+    categories = list(Category.objects.values_list('title_fa', flat=True))
+    middle = Recipe.objects.order_by('-published_date', '-id')[recipes // 2]
+
+    # The queries go through the models of the migration state: the current
+    # models have columns which do not exist at 0009_remove_duplicates
+    def recipe_lookup(apps):
+        Recipe = apps.get_model('recipes', 'Recipe')
+        for origin_id in origin_ids:
+            Recipe.objects.filter(origin_id=str(origin_id)).exists()
+
+    def step_lookup(apps):
+        CookingStep = apps.get_model('recipes', 'CookingStep')
+        for recipe_id in recipe_ids:
+            CookingStep.objects.filter(recipe_id=recipe_id, order=steps).exists()
+
+    def category_lookup(apps):
+        Category = apps.get_model('recipes', 'Category')
+        for title in categories:
+            Category.objects.get(title_fa=title)
+
+    def author_lookup(apps):
+        Author = apps.get_model('recipes', 'Author')
+        for i in range(lookups):
+            Author.objects.get(title_en='Tayebeh')
+
+    def first_page(apps):
+        Recipe = apps.get_model('recipes', 'Recipe')
+        list(Recipe.objects.order_by('-published_date', '-id')[:21])
+
+    def cursor_page(apps):
+        Recipe = apps.get_model('recipes', 'Recipe')
+        list(Recipe.objects.filter(
+            Q(published_date__lt=middle.published_date)
+            | Q(published_date=middle.published_date, id__lt=middle.pk)
+        ).order_by('-published_date', '-id')[:21])
+
+    cases = [
+        ('pipeline: %d recipes by origin_id' % lookups, recipe_lookup, 1),
+        ('pipeline: %d steps by (recipe, order)' % lookups, step_lookup, 1),
+        ('pipeline: %d categories by title_fa' % len(categories), category_lookup, 1),
+        ('pipeline: %d authors by title_en' % lookups, author_lookup, 1),
+        ('all_posts: first page', first_page, 20),
+        ('all_posts: page in the middle', cursor_page, 20),
+    ]
+    apps = migrate(('recipes', '0009_remove_duplicates'))
+    before = [measure(lambda: func(apps), repeat) for name, func, repeat in cases]
+    apps = migrate(('recipes', '0010_lookup_indexes'))
+    after = [measure(lambda: func(apps), repeat) for name, func, repeat in cases]
+
+    stdout.write('%-45s %12s %12s %8s' % ('', 'before (ms)', 'after (ms)', 'speedup'))
+    for (name, func, repeat), old, new in zip(cases, before, after):
+        stdout.write('%-45s %12.2f %12.2f %7.1fx' % (name, old, new, old / new))
+
+
+def legacy_extract_steps(content):
+    '''
+    The step extraction of the spider before recipes.content: images by parsel,
+    descriptions by splitting on "<img" and a regex compiled for each step.
+    '''
+    from parsel import Selector
+
+    images = Selector(text=content).xpath('//img/@src').getall()
+    sections = content.split('<img')[1:]
+    descriptions = []
+    for section in sections:
+        cleanr = re.compile('<.*?>|&([a-z0-9]+|#[0-9]{1,6}|#x[0-9a-f]{1,6});')
+        descriptions.append(re.sub(cleanr, '', '<img' + section))
+    return list(zip(images, descriptions))
+
+
+@benchmark
+def step_extraction(stdout, recipes=50000, steps=5, **options):
+    '''
+    Extracting the cooking steps from the content of "recipes" blog posts with
+    "steps" images each, before and after recipes.content.
+    '''
+    step = ('<div class="separator" style="clear: both; text-align: center;">'
+            '<a href="https://1.bp.blogspot.com/%(i)d/s1600/%(o)d.jpg" '
+            'imageanchor="1"><img border="0" height="300" '
+            'src="https://1.bp.blogspot.com/%(i)d/s400/%(o)d.jpg" width="400" />'
+            '</a></div><div dir="rtl">مرحله %(o)d: آرد و شکر را&nbsp;با هم '
+            'مخلوط کنید.<br /></div>')
+    contents = ['<div dir="rtl">سلام دوستان</div>' + ''.join(
+        step % {'i': i, 'o': order} for order in range(1, steps + 1))
+        for i in range(recipes)]
+
+    def legacy():
+        for content in contents:
+            legacy_extract_steps(content)
+
+    def single_pass():
+        for content in contents:
+            list(extract_steps(content))
+
+    old = measure(legacy)
+    new = measure(single_pass)
+    stdout.write('%-45s %12s %12s %8s' % ('', 'before (ms)', 'after (ms)', 'speedup'))
+    stdout.write('%-45s %12.2f %12.2f %7.1fx' % (
+        '%d posts, %d steps each' % (recipes, steps), old, new, old / new))
+
+
+def legacy_update_translated_state(queryset):
+    '''
+    The update_translated_state admin action before
+    RecipeQuerySet.update_translated_state: the translated steps are loaded in
+    a set for each recipe and the recipes are saved one by one.
+    '''
+    ok_steps = CookingStep.objects.filter(
+        ~Q(description_en='') | Q(description_fa__in=['', '-']))
+    queryset = queryset.prefetch_related('steps').filter(translated=False)
+    for item in queryset:
+        if set(item.steps.all()).issubset(set(ok_steps)):
+            if item.title_en != "":
+                item.translated = True
+                item.save()
+
+
+@benchmark
+def translated_state(stdout, recipes=50000, steps=5, **options):
+    '''
+    update_translated_state on a catalogue where every other recipe is
+    translated, before and after the set-based UPDATE. The legacy action is
+    only run on the first 1000 recipes, since it loads all steps per recipe.
+    '''
+    create_catalogue(recipes, steps, step_factory=lambda index, order: {
+        'description_en': 'Step %d' % order if index % 2 == 0 else ''})
+    Recipe.objects.update(title_en='Food')
+    legacy_ids = list(Recipe.objects.order_by('pk').values_list(
+        'pk', flat=True)[:min(recipes, 1000)])
+
+    def set_based(queryset):
+        queryset.update_translated_state()
+
+    def run(func, queryset):
+        Recipe.objects.update(translated=False)
+        with CaptureQueriesContext(connection) as queries:
+            elapsed = measure(lambda: func(queryset))
+        return elapsed, len(queries), Recipe.objects.filter(translated=True).count()
+
+    cases = [
+        ('legacy: %d recipes' % len(legacy_ids), legacy_update_translated_state,
+         Recipe.objects.filter(pk__in=legacy_ids)),
+        ('set-based: %d recipes' % len(legacy_ids), set_based,
+         Recipe.objects.filter(pk__in=legacy_ids)),
+        ('set-based: %d recipes' % recipes, set_based, Recipe.objects.all()),
+    ]
+    stdout.write('%-45s %12s %8s %10s' % ('', 'time (ms)', 'queries', 'translated'))
+    for name, func, queryset in cases:
+        stdout.write('%-45s %12.2f %8d %10d' % ((name,) + run(func, queryset)))
+
+
+@benchmark
+def export(stdout, recipes=50000, steps=5, **options):
+    '''
+    Streaming export of the catalogue (recipes.export): run time and peak
+    memory of exporting a part and all of the recipes, the peak should not
+    grow with the number of recipes.
+    '''
+    create_catalogue(recipes, steps)
+
+    def run(format, count, compress=False):
+        last = Recipe.objects.order_by('pk').values_list('pk', flat=True)[count - 1]
+        queryset = Recipe.objects.filter(pk__lte=last)
+        size = 0
+        tracemalloc.start()
+        start = time.perf_counter()
+        for chunk in export_recipes(queryset, format=format, compress=compress):
+            size += len(chunk)
+        elapsed = (time.perf_counter() - start) * 1000
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return elapsed, peak / 1024 / 1024, size / 1024 / 1024
+
+    stdout.write('%-45s %12s %10s %10s' % ('', 'time (ms)', 'peak (MB)', 'size (MB)'))
+    for format, compress in [('jsonl', False), ('csv', False), ('jsonl', True)]:
+        for count in (recipes // 10, recipes):
+            name = '%s%s: %d recipes' % (format, '.gz' if compress else '', count)
+            stdout.write('%-45s %12.2f %10.2f %10.2f' % (
+                (name,) + run(format, count, compress)))
+
+
+@benchmark
+def load(stdout, recipes=50000, steps=5, **options):
+    '''
+    Loading a dump of "recipes" recipes (recipes.load) into the empty database,
+    then loading it again, when all the recipes already exist.
+    '''
+    published = timezone.now().isoformat()
+    author = {'title_fa': 'طیبه', 'title_en': 'Tayebeh', 'website': None,
+              'email': None, 'image': None}
+    dump = [{
+        'origin_id': str(i), 'title_fa': 'غذای %d' % i, 'title_en': 'Food %d' % i,
+        'author': author, 'published_date': published, 'updated_date': published,
+        'self_link': None, 'alternate_link': None, 'translated': False,
+        'categories': [{'title_fa': 'دسته %d' % (j % 40),
+                        'title_en': 'Category %d' % (j % 40)} for j in (i, i + 1)],
+        'steps': [{'order': order, 'image': 'http://example.com/%d/%d.jpg' % (i, order),
+                   'image_path': None, 'description_fa': 'مرحله %d' % order,
+                   'description_en': ''} for order in range(1, steps + 1)],
+    } for i in range(recipes)]
+
+    stdout.write('%-45s %12s %10s %10s' % ('', 'time (ms)', 'recipes/s', 'rows/s'))
+    for name in ('empty database', 'existing recipes'):
+        loader = RecipeLoader()
+        elapsed = measure(lambda: loader.load(dump))
+        stdout.write('%-45s %12.2f %10.0f %10.0f' % (
+            '%s: %d recipes' % (name, recipes), elapsed,
+            len(dump) * 1000 / elapsed, loader.rows * 1000 / elapsed))
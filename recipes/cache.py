@@ -0,0 +1,98 @@
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import models
+
+# Every write to recipes, cooking steps, categories or authors bumps the content
+# version. Cached payloads are keyed by this version, so a bump invalidates all
+# of them at once and old entries just expire.
+# NOTE: The spider pipeline runs in another process, so in production the cache
+# backend should be a shared one (memcached, redis, database). locmem is enough
+# for tests and development.
+CONTENT_VERSION_KEY = 'recipes:content_version'
+LOCK_TIMEOUT = 10
+LOCK_WAIT_INTERVAL = 0.05
+
+
+def get_cache():
+    return caches[getattr(settings, 'RECIPES_CACHE', 'default')]
+
+
+def get_content_version():
+    cache = get_cache()
+    version = cache.get(CONTENT_VERSION_KEY)
+    if version is None:
+        # Start from the current time, so a version which is evicted from the
+        # cache never goes back to a value that has been used before.
+        cache.add(CONTENT_VERSION_KEY, int(time.time() * 1000), None)
+        version = cache.get(CONTENT_VERSION_KEY)
+    return version
+
+
+def bump_content_version():
+    cache = get_cache()
+    try:
+        cache.incr(CONTENT_VERSION_KEY)
+    except ValueError:
+        # The key is missing, initializing it is a new version too.
+        get_content_version()
+
+
+def get_or_build(name, build, timeout=None):
+    '''
+    Returns the cached value of "name" for the current content version.
+    On a miss only one caller builds the value (it holds a lock in the cache),
+    the others wait for it instead of running the same queries concurrently.
+    If the builder does not finish in LOCK_TIMEOUT seconds, waiters build the
+    value themselves.
+    '''
+    cache = get_cache()
+    if timeout is None:
+        timeout = getattr(settings, 'RECIPES_CACHE_TIMEOUT', 60 * 60)
+    key = 'recipes:%s:%s' % (name, get_content_version())
+    value = cache.get(key)
+    if value is not None:
+        return value
+
+    lock_key = key + ':lock'
+    if cache.add(lock_key, 1, LOCK_TIMEOUT):
+        try:
+            value = build()
+            cache.set(key, value, timeout)
+        finally:
+            cache.delete(lock_key)
+        return value
+
+    deadline = time.monotonic() + LOCK_TIMEOUT
+    while time.monotonic() < deadline:
+        time.sleep(LOCK_WAIT_INTERVAL)
+        value = cache.get(key)
+        if value is not None:
+            return value
+        if cache.get(lock_key) is None:
+            break
+    value = build()
+    cache.set(key, value, timeout)
+    return value
+
+
+class ContentVersionQuerySet(models.QuerySet):
+    '''
+    QuerySet.update() and bulk_create() do not send post_save signals,
+    so bump the content version here too (bulk_update() uses update()).
+    '''
+
+    def update(self, **kwargs):
+        rows = super().update(**kwargs)
+        if rows:
+            bump_content_version()
+        return rows
+
+    update.alters_data = True
+
+    def bulk_create(self, *args, **kwargs):
+        objs = super().bulk_create(*args, **kwargs)
+        if objs:
+            bump_content_version()
+        return objs
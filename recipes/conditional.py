@@ -0,0 +1,38 @@
+import hashlib
+
+from django.db.models import Count, Max
+from django.views.decorators.http import condition
+from django.views.decorators.vary import vary_on_headers
+
+from .cache import get_content_version
+from .models import Recipe
+
+
+def recipes_etag(request, *args, **kwargs):
+    '''
+    Returns the ETag of the recipes content in the representation which is
+    asked for. It is made of one cheap aggregate query (count + latest updated
+    and crawled dates), the content version of recipes.cache, which changes on
+    edits that don't touch recipe dates (e.g. translating a cooking step), the
+    query string (fields, lang, cursor, ...) and the Accept header, which
+    chooses the renderer.
+    NOTE: There is no Last-Modified header: the dates of recipes do not change
+    on those edits, so If-Modified-Since would answer 304 for changed content.
+    '''
+    aggregate = Recipe.objects.aggregate(
+        count=Count('id'),
+        updated=Max('updated_date'),
+        crowled=Max('crowled_date'))
+    raw = '%s:%s:%s:%s:%s:%s' % (
+        get_content_version(), aggregate['count'], aggregate['updated'],
+        aggregate['crowled'], request.get_full_path(),
+        request.META.get('HTTP_ACCEPT', ''))
+    return '"%s"' % hashlib.md5(raw.encode('utf-8')).hexdigest()
+
+
+def recipes_condition(view):
+    '''
+    Adds the ETag header and answers "304 Not Modified" before the view runs if
+    the ETag of the client matches.
+    '''
+    return vary_on_headers('Accept')(condition(etag_func=recipes_etag)(view))
@@ -0,0 +1,81 @@
+'''
+Extract the cooking steps from the content (HTML) of a blog post.
+A step is an image and the text after it, until the next image. The content
+is scanned once: the tags are removed while the steps are split, and the HTML
+entities of the text and the image urls are decoded.
+Some posts use smilies (emoji images) inside the text, they are not steps of
+their own: see merge_smilies().
+'''
+import html
+import re
+
+# Any tag; group 1 is set for image tags
+TAG = re.compile(r'<(img\b)?[^>]*>', re.IGNORECASE)
+SRC = re.compile(r'''\ssrc\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+))''',
+                 re.IGNORECASE)
+
+# Hosts and paths of the smiley images used in the posts
+SMILEY = re.compile(r'smiles|emoticon|cheesebuerger\.de/', re.IGNORECASE)
+
+
+def _text(parts):
+    return html.unescape(''.join(parts)).replace('\xa0', ' ')
+
+
+def _src(tag):
+    match = SRC.search(tag)
+    if match is None:
+        return None
+    return html.unescape(next(group for group in match.groups() if group is not None))
+
+
+def extract_steps(content):
+    '''
+    Yields (image, description) of the steps in the content.
+    The text before the first image is not a step. Images without src are
+    ignored, their text belongs to the previous step.
+    '''
+    if not content:
+        return
+    image = None
+    parts = []
+    position = 0
+    for tag in TAG.finditer(content):
+        if image is not None:
+            parts.append(content[position:tag.start()])
+        position = tag.end()
+        if tag.group(1):
+            src = _src(tag.group())
+            if src is None:
+                continue
+            if image is not None:
+                yield image, _text(parts)
+            image = src
+            parts = []
+    if image is not None:
+        parts.append(content[position:])
+        yield image, _text(parts)
+
+
+def is_smiley(image):
+    return bool(image) and SMILEY.search(image) is not None
+
+
+def merge_smilies(images):
+    '''
+    Group the steps (given by their images, in order) for merging the smilies:
+    returns a list of groups of step indexes, the first step of each group is
+    kept and the descriptions of the rest (smilies) are appended to it.
+    Smilies at the start have no previous step, they are kept.
+    '''
+    groups = []
+    for index, image in enumerate(images):
+        if groups and is_smiley(image):
+            groups[-1].append(index)
+        else:
+            groups.append([index])
+    return groups
+
+
+def join_descriptions(descriptions):
+    return ' '.join(text for text in descriptions if text)
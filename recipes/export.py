@@ -0,0 +1,127 @@
+'''
+Export of the recipe catalogue with the cooking steps and categories, for the
+search cluster and analytics:
+- jsonl: one JSON object per line for each recipe,
+- csv: one row for each recipe, the author is its english name, the persian
+  titles of categories are joined by "|" and the steps are a JSON list.
+The export is a generator of bytes: recipes are read chunk_size at a time
+(their author, categories and steps are loaded for each chunk), so the memory
+does not grow with the size of the catalogue. It can be gzipped on the fly.
+A JSON Lines export can be loaded into another database by recipes.load.
+'''
+import csv
+import json
+import zlib
+
+from .models import Recipe
+
+FORMATS = ('jsonl', 'csv')
+AUTHOR_FIELDS = ('title_fa', 'title_en', 'website', 'email', 'image')
+CATEGORY_FIELDS = ('title_fa', 'title_en')
+CSV_FIELDS = ['id', 'origin_id', 'title_fa', 'title_en', 'author',
+              'published_date', 'updated_date', 'self_link', 'alternate_link',
+              'translated', 'categories', 'step_count', 'steps']
+
+
+def iter_recipes(queryset=None, chunk_size=500):
+    '''
+    Yields the recipes of the queryset (all of them by default) ordered by id,
+    with their related objects. The ids are read by iterator(), then each
+    chunk of recipes is loaded by with_related().
+    '''
+    if queryset is None:
+        queryset = Recipe.objects.all()
+    ids = queryset.order_by('pk').values_list('pk', flat=True)
+    chunk = []
+    for pk in ids.iterator(chunk_size=chunk_size):
+        chunk.append(pk)
+        if len(chunk) >= chunk_size:
+            yield from _load_chunk(chunk)
+            chunk = []
+    if chunk:
+        yield from _load_chunk(chunk)
+
+
+def _load_chunk(ids):
+    return Recipe.objects.filter(pk__in=ids).with_related().order_by('pk')
+
+
+def _date(value):
+    return value.isoformat() if value is not None else None
+
+
+def recipe_data(recipe):
+    return {
+        'id': recipe.pk,
+        'origin_id': recipe.origin_id,
+        'title_fa': recipe.title_fa,
+        'title_en': recipe.title_en,
+        'author': {name: getattr(recipe.author, name) for name in AUTHOR_FIELDS},
+        'published_date': _date(recipe.published_date),
+        'updated_date': _date(recipe.updated_date),
+        'self_link': recipe.self_link,
+        'alternate_link': recipe.alternate_link,
+        'translated': recipe.translated,
+        'categories': [{name: getattr(category, name) for name in CATEGORY_FIELDS}
+                       for category in recipe.categories.all()],
+        'steps': [{
+            'order': step.order,
+            'image': step.image,
+            'image_path': step.image_path,
+            'description_fa': step.description_fa,
+            'description_en': step.description_en,
+        } for step in recipe.ordered_steps],
+    }
+
+
+def export_jsonl(recipes):
+    for recipe in recipes:
+        yield json.dumps(recipe_data(recipe), ensure_ascii=False) + '\n'
+
+
+class _Line(object):
+    '''
+    File-like object for csv.writer which returns the written line.
+    '''
+
+    def write(self, value):
+        return value
+
+
+def export_csv(recipes):
+    writer = csv.writer(_Line())
+    yield writer.writerow(CSV_FIELDS)
+    for recipe in recipes:
+        data = recipe_data(recipe)
+        data['author'] = data['author']['title_en']
+        data['categories'] = '|'.join(
+            category['title_fa'] for category in data['categories'])
+        data['step_count'] = len(data['steps'])
+        data['steps'] = json.dumps(data['steps'], ensure_ascii=False)
+        yield writer.writerow([data[name] for name in CSV_FIELDS])
+
+
+def gzip_stream(chunks, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_recipes(queryset=None, format='jsonl', chunk_size=500, compress=False):
+    '''
+    Returns a generator of the bytes of the export.
+    '''
+    if format not in FORMATS:
+        raise ValueError('format must be one of: %s' % ', '.join(FORMATS))
+    recipes = iter_recipes(queryset, chunk_size)
+    if format == 'jsonl':
+        lines = export_jsonl(recipes)
+    else:
+        lines = export_csv(recipes)
+    chunks = (line.encode('utf-8') for line in lines)
+    if compress:
+        chunks = gzip_stream(chunks)
+    return chunks
@@ -0,0 +1,143 @@
+'''
+A small job queue in the database for long running admin actions.
+An action which is defined by queued_action() does not run in the admin
+request: the selected objects are split into jobs of RECIPES_JOB_CHUNK_SIZE
+objects (default 500) and the worker runs them:
+    python manage.py run_jobs
+Status, progress and results of the jobs are shown in the admin (Jobs).
+While a job is running, its worker updates heartbeat_date of the job every
+RECIPES_JOB_HEARTBEAT seconds (default 60). A running job whose heartbeat is
+older than RECIPES_JOB_TIMEOUT seconds (default 600) is taken again, as its
+worker has stopped. If that worker was only stalled, it does not save the
+result of the job when it finishes.
+'''
+import functools
+import json
+import logging
+import threading
+import traceback
+import uuid
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import Job
+
+logger = logging.getLogger(__name__)
+
+# name -> (model, function)
+TASKS = {}
+
+
+def queued_action(model):
+    '''
+    Register the function (which takes a queryset of model and may return a
+    message) as a task, and return an admin action which enqueues it.
+    The function itself is kept as "task" of the action.
+    '''
+    def decorator(func):
+        TASKS[func.__name__] = (model, func)
+
+        @functools.wraps(func)
+        def action(modeladmin, request, queryset):
+            jobs = enqueue(func.__name__, queryset)
+            modeladmin.message_user(
+                request, '%d objects are queued in %d jobs, see the progress in Jobs.'
+                % (sum(job.object_count for job in jobs), len(jobs)))
+
+        action.task = func
+        return action
+    return decorator
+
+
+def enqueue(name, queryset, chunk_size=None):
+    if chunk_size is None:
+        chunk_size = getattr(settings, 'RECIPES_JOB_CHUNK_SIZE', 500)
+    ids = list(queryset.order_by('pk').values_list('pk', flat=True))
+    group = uuid.uuid4().hex
+    return Job.objects.bulk_create([
+        Job(task=name, group=group, object_ids=json.dumps(ids[start:start + chunk_size]),
+            object_count=len(ids[start:start + chunk_size]))
+        for start in range(0, len(ids), chunk_size)])
+
+
+def claim_job():
+    '''
+    Take the oldest pending job, or a running job with no heartbeat for
+    RECIPES_JOB_TIMEOUT seconds. The status is changed by a conditional
+    UPDATE, so two workers can not take the same job at once. started_date
+    of the job identifies the claim: a worker whose job is taken again no
+    longer has it, and run_job() does not save its result.
+    '''
+    now = timezone.now()
+    timeout = getattr(settings, 'RECIPES_JOB_TIMEOUT', 10 * 60)
+    stale = Q(status=Job.RUNNING, heartbeat_date__lt=now - timedelta(seconds=timeout))
+    for job in Job.objects.filter(Q(status=Job.PENDING) | stale).order_by('id')[:10]:
+        claimed = Job.objects.filter(
+            pk=job.pk, status=job.status, started_date=job.started_date
+        ).update(status=Job.RUNNING, started_date=now, heartbeat_date=now)
+        if claimed:
+            job.status = Job.RUNNING
+            job.started_date = job.heartbeat_date = now
+            return job
+    return None
+
+
+class Heartbeat(threading.Thread):
+    '''
+    Updates heartbeat_date of a claimed job every RECIPES_JOB_HEARTBEAT
+    seconds until it is stopped.
+    '''
+
+    def __init__(self, job):
+        super().__init__(name='heartbeat of %s' % job, daemon=True)
+        self.job = job
+        self.interval = getattr(settings, 'RECIPES_JOB_HEARTBEAT', 60)
+        self.stopped = threading.Event()
+
+    def run(self):
+        try:
+            while not self.stopped.wait(self.interval):
+                Job.objects.filter(
+                    pk=self.job.pk, status=Job.RUNNING, started_date=self.job.started_date
+                ).update(heartbeat_date=timezone.now())
+        finally:
+            # The connection of this thread
+            connection.close()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def run_job(job):
+    '''
+    Run a claimed job and save its status and result. Returns None and saves
+    nothing if the job has been taken by another worker in the meantime.
+    '''
+    heartbeat = Heartbeat(job)
+    heartbeat.start()
+    try:
+        model, func = TASKS[job.task]
+        queryset = model.objects.filter(pk__in=json.loads(job.object_ids))
+        job.result = func(queryset) or ''
+        job.status = Job.DONE
+    except Exception:
+        logger.exception('Job %s failed' % job)
+        job.error = traceback.format_exc()
+        job.status = Job.FAILED
+    finally:
+        heartbeat.stop()
+    job.finished_date = timezone.now()
+    saved = Job.objects.filter(
+        pk=job.pk, status=Job.RUNNING, started_date=job.started_date
+    ).update(status=job.status, result=job.result, error=job.error,
+             finished_date=job.finished_date)
+    if not saved:
+        logger.error('Job %s is taken by another worker, its result is not saved' % job)
+        return None
+    return job
@@ -0,0 +1,195 @@
+'''
+Load a JSON Lines dump of recipes (made by recipes.export) into the database,
+e.g. to seed a new environment without crawling the site again:
+    python manage.py loadrecipes recipes.jsonl.gz
+Each batch of recipes is stored in one transaction by bulk_create(): authors
+and categories which do not exist yet, recipes, their cooking steps and the
+links to categories. Recipes which already exist (by origin_id) are skipped
+with their steps, so a dump can be loaded into a database which is not empty.
+Recipes without origin_id cannot be told apart, they are skipped and counted
+as "unidentified". Recipes without an author, or with a category without its
+persian title or a step without its order, are skipped and counted as
+"invalid". The other fields may be missing.
+bulk_create() sends no signals, so the denormalized data which the signals
+keep is made at once: the search index and the status of the loaded recipes
+for each batch, the recipe count of categories at the end. With index=False
+(loadrecipes --no-index) nothing is indexed, the index is made afterwards by
+"python manage.py rebuild_search_index".
+'''
+import functools
+import operator
+import time
+
+from django.db import transaction
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+from . import search
+from .export import AUTHOR_FIELDS, CATEGORY_FIELDS
+from .models import Author, Category, CookingStep, Recipe
+
+RECIPE_FIELDS = ('title_fa', 'title_en', 'self_link', 'alternate_link',
+                 'translated')
+STEP_FIELDS = ('image', 'image_path', 'description_fa', 'description_en')
+
+
+def _any_of(records):
+    '''
+    Q object which matches rows with any of the records (dicts of field
+    values), a None value matches NULL. Only for authors, which are told apart
+    by all of their fields.
+    '''
+    return functools.reduce(operator.or_, (Q(**record) for record in records))
+
+
+def _is_valid(data):
+    '''
+    Check if a recipe of the dump has the records which it cannot be stored
+    without: its author, the persian title of its categories and the order of
+    its steps.
+    '''
+    return (isinstance(data.get('author'), dict)
+            and all(isinstance(category, dict) and category.get('title_fa')
+                    for category in data.get('categories') or [])
+            and all(isinstance(step, dict) and step.get('order') is not None
+                    for step in data.get('steps') or []))
+
+
+def _author_key(author):
+    return tuple(author.get(name) for name in AUTHOR_FIELDS)
+
+
+class RecipeLoader(object):
+    '''
+    Loads the recipes (dicts of a dump) batch_size at a time. progress(loader)
+    is called after each batch, the numbers of loaded rows are in "counts".
+    '''
+
+    def __init__(self, batch_size=500, progress=None, index=True):
+        self.batch_size = batch_size
+        self.progress = progress
+        self.index = index
+        # Authors have no unique field, they are told apart by all of their
+        # fields. Categories are found by their unique persian title.
+        self.authors = {}
+        self.categories = {}
+        self.linked_categories = set()
+        self.counts = {'recipes': 0, 'skipped': 0, 'unidentified': 0, 'invalid': 0,
+                       'steps': 0, 'categories': 0}
+        self.started = None
+
+    @property
+    def rows(self):
+        return self.counts['recipes'] + self.counts['steps'] + self.counts['categories']
+
+    @property
+    def rows_per_second(self):
+        elapsed = time.monotonic() - self.started
+        return self.rows / elapsed if elapsed else 0
+
+    def load(self, recipes):
+        self.started = time.monotonic()
+        self.authors = {}
+        self.add_author_ids(Author.objects.all())
+        self.categories = dict(Category.objects.values_list('title_fa', 'pk'))
+        batch = []
+        for data in recipes:
+            batch.append(data)
+            if len(batch) >= self.batch_size:
+                self.load_batch(batch)
+                batch = []
+        if batch:
+            self.load_batch(batch)
+        # Recounting for each batch would count the links of all the
+        # recipes which are loaded so far
+        Category.update_recipe_count(self.linked_categories)
+        return self.counts
+
+    def load_batch(self, batch):
+        valid = []
+        for data in batch:
+            if data.get('origin_id') is None:
+                self.counts['unidentified'] += 1
+            elif not _is_valid(data):
+                self.counts['invalid'] += 1
+            else:
+                valid.append(data)
+        batch = valid
+        with transaction.atomic():
+            existing = set(Recipe.objects.filter(origin_id__in=[
+                data['origin_id'] for data in batch]).values_list('origin_id', flat=True))
+            new = {}
+            for data in batch:
+                if data['origin_id'] in existing or data['origin_id'] in new:
+                    self.counts['skipped'] += 1
+                    continue
+                new[data['origin_id']] = data
+            if new:
+                self.add_authors(new.values())
+                self.add_categories(new.values())
+                self.add_recipes(new)
+        if self.progress is not None:
+            self.progress(self)
+
+    def add_author_ids(self, authors):
+        for values in authors.values_list(*AUTHOR_FIELDS, 'pk'):
+            self.authors.setdefault(values[:-1], values[-1])
+
+    def add_authors(self, recipes):
+        keys = {_author_key(data['author']) for data in recipes} - set(self.authors)
+        if not keys:
+            return
+        records = [dict(zip(AUTHOR_FIELDS, key)) for key in keys]
+        Author.objects.bulk_create([Author(**record) for record in records])
+        # bulk_create() does not set the primary keys on every database
+        self.add_author_ids(Author.objects.filter(_any_of(records)))
+
+    def add_categories(self, recipes):
+        new = {category['title_fa']: category for data in recipes
+               for category in data.get('categories') or []
+               if category['title_fa'] not in self.categories}
+        if not new:
+            return
+        Category.objects.bulk_create([
+            Category(**{name: category.get(name) for name in CATEGORY_FIELDS})
+            for category in new.values()], ignore_conflicts=True)
+        for title, pk in Category.objects.filter(
+                title_fa__in=list(new)).values_list('title_fa', 'pk'):
+            self.categories.setdefault(title, pk)
+
+    def add_recipes(self, new):
+        Recipe.objects.bulk_create([
+            Recipe(origin_id=origin_id,
+                   author_id=self.authors[_author_key(data['author'])],
+                   published_date=parse_datetime(data.get('published_date') or ''),
+                   updated_date=parse_datetime(data.get('updated_date') or ''),
+                   **{name: data[name] for name in RECIPE_FIELDS if name in data})
+            for origin_id, data in new.items()], ignore_conflicts=True)
+        recipes = list(Recipe.objects.filter(origin_id__in=list(new)).values_list(
+            'origin_id', 'pk', 'title_fa', 'title_en'))
+        recipe_ids = {origin_id: pk for origin_id, pk, title_fa, title_en in recipes}
+
+        steps = CookingStep.objects.bulk_create([
+            CookingStep(recipe_id=recipe_ids[origin_id], order=step['order'],
+                        is_empty=step.get('description_fa') in ('', '-', None),
+                        **{name: step.get(name) for name in STEP_FIELDS})
+            for origin_id, data in new.items() if origin_id in recipe_ids
+            for step in data.get('steps') or []], ignore_conflicts=True)
+        RecipeCategory = Recipe.categories.through
+        links = RecipeCategory.objects.bulk_create([
+            RecipeCategory(recipe_id=recipe_ids[origin_id],
+                           category_id=self.categories[category['title_fa']])
+            for origin_id, data in new.items() if origin_id in recipe_ids
+            for category in data.get('categories') or []], ignore_conflicts=True)
+        self.linked_categories.update(link.category_id for link in links)
+        if self.index:
+            # Only the loaded rows, bulk_create() does not set the primary
+            # keys of the steps on every database
+            search.index_rows(
+                [recipe[1:] for recipe in recipes],
+                CookingStep.objects.filter(recipe_id__in=list(recipe_ids.values()))
+                .values_list('pk', 'recipe_id', 'description_fa', 'description_en'))
+        Recipe.update_status(list(recipe_ids.values()), steps=False)
+        self.counts['recipes'] += len(recipe_ids)
+        self.counts['steps'] += len(steps)
+        self.counts['categories'] += len(links)
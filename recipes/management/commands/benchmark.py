@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from recipes.benchmarks import BENCHMARKS, benchmark_database
+
+
+class Command(BaseCommand):
+    help = ('Run a benchmark on a synthetic catalogue in a throwaway test '
+            'database. Available benchmarks: %s' % ', '.join(sorted(BENCHMARKS)))
+
+    def add_arguments(self, parser):
+        parser.add_argument('name', choices=sorted(BENCHMARKS))
+        parser.add_argument('--recipes', type=int, default=50000)
+        parser.add_argument('--steps', type=int, default=5,
+                            help='Cooking steps of each recipe.')
+
+    def handle(self, *args, **options):
+        with benchmark_database():
+            BENCHMARKS[options['name']](
+                self.stdout, recipes=options['recipes'], steps=options['steps'])
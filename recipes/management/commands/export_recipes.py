@@ -0,0 +1,37 @@
+import sys
+
+from django.core.management.base import BaseCommand
+
+from recipes.export import FORMATS, export_recipes
+
+
+class Command(BaseCommand):
+    help = ('Export the recipes with their cooking steps and categories as JSON '
+            'Lines or CSV (see recipes.export), e.g. '
+            'export_recipes --format csv --gzip -o recipes.csv.gz')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=FORMATS, default='jsonl')
+        parser.add_argument('-o', '--output', default='-',
+                            help='Output file, "-" for the standard output.')
+        parser.add_argument('--gzip', action='store_true',
+                            help='Compress the output with gzip.')
+        parser.add_argument('--chunk-size', type=int, default=500,
+                            help='Recipes which are loaded at a time.')
+
+    def handle(self, *args, **options):
+        chunks = export_recipes(format=options['format'],
+                                chunk_size=options['chunk_size'],
+                                compress=options['gzip'])
+        if options['output'] == '-':
+            self.write(sys.stdout.buffer, chunks)
+            return
+        with open(options['output'], 'wb') as output:
+            self.write(output, chunks)
+        self.stderr.write(self.style.SUCCESS(
+            'The recipes are exported to %s.' % options['output']))
+
+    def write(self, output, chunks):
+        for chunk in chunks:
+            output.write(chunk)
+        output.flush()
@@ -0,0 +1,56 @@
+import gzip
+import json
+import sys
+
+from django.core.management.base import BaseCommand
+
+from recipes.load import RecipeLoader
+
+
+class Command(BaseCommand):
+    help = ('Load a JSON Lines dump of recipes (see export_recipes) into the '
+            'database. Recipes which already exist are skipped.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='The dump (.jsonl or .jsonl.gz), "-" for '
+                                         'the standard input.')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Recipes which are stored in one transaction.')
+        parser.add_argument('--no-index', action='store_false', dest='index',
+                            help='Do not index the loaded recipes for search, e.g. '
+                                 'for a large dump. Run rebuild_search_index '
+                                 'afterwards.')
+
+    def handle(self, *args, **options):
+        self.verbosity = options['verbosity']
+        loader = RecipeLoader(batch_size=options['batch_size'],
+                              progress=self.report, index=options['index'])
+        path = options['path']
+        if path == '-':
+            counts = loader.load(self.read(sys.stdin))
+        else:
+            opener = gzip.open if path.endswith('.gz') else open
+            with opener(path, 'rt', encoding='utf-8') as f:
+                counts = loader.load(self.read(f))
+        self.stdout.write(self.style.SUCCESS(
+            '%(recipes)d recipes, %(steps)d cooking steps and %(categories)d '
+            'category links are loaded, %(skipped)d recipes are skipped.' % counts))
+        if counts['unidentified']:
+            self.stderr.write(self.style.WARNING(
+                '%(unidentified)d recipes without origin_id are skipped.' % counts))
+        if counts['invalid']:
+            self.stderr.write(self.style.WARNING(
+                '%(invalid)d recipes without an author, a category title or a '
+                'step order are skipped.' % counts))
+
+    def read(self, lines):
+        for line in lines:
+            if line.strip():
+                yield json.loads(line)
+
+    def report(self, loader):
+        if self.verbosity >= 1:
+            self.stderr.write('%d recipes, %d rows (%.0f rows/s)' % (
+                loader.counts['recipes'] + loader.counts['skipped']
+                + loader.counts['unidentified'] + loader.counts['invalid'],
+                loader.rows, loader.rows_per_second))
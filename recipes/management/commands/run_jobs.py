@@ -0,0 +1,36 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+import recipes.admin  # noqa: the queued admin actions are registered there
+from recipes.jobs import claim_job, run_job
+
+
+class Command(BaseCommand):
+    help = 'Run the queued jobs of the admin actions (see recipes.jobs).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help='Exit when there is no pending job.')
+        parser.add_argument('--sleep', type=float, default=2,
+                            help='Seconds to wait when there is no pending job.')
+
+    def handle(self, *args, **options):
+        while True:
+            # The worker runs for a long time, like the requests of a web
+            # server it must not keep a broken or too old connection
+            close_old_connections()
+            job = claim_job()
+            if job is None:
+                if options['once']:
+                    return
+                time.sleep(options['sleep'])
+                continue
+            if run_job(job) is None:
+                self.stdout.write(self.style.WARNING(
+                    '%s: taken by another worker, the result is not saved' % job))
+            elif job.status == job.DONE:
+                self.stdout.write(self.style.SUCCESS('%s: done %s' % (job, job.result)))
+            else:
+                self.stdout.write(self.style.ERROR('%s: failed' % job))
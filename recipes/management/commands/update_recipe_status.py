@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from recipes.models import Recipe
+
+
+class Command(BaseCommand):
+    help = ('Fill the status columns of recipes and cooking steps (has_smilies, '
+            'manually_translatable, untranslated_step_count, is_empty), e.g. '
+            'after they are added or the steps are changed outside of Django.')
+
+    def handle(self, *args, **options):
+        count = Recipe.update_status()
+        self.stdout.write(self.style.SUCCESS(
+            'The status of %d recipes is updated.' % count))
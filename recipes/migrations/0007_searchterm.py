@@ -0,0 +1,28 @@
+# Generated by Django 3.0.5 on 2026-10-18 13:18
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0006_auto_20200905_0325'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchTerm',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('term', models.CharField(max_length=100)),
+                ('weight', models.IntegerField(default=1)),
+                ('recipe', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='search_terms', to='recipes.Recipe')),
+                ('step', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='search_terms', to='recipes.CookingStep')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='searchterm',
+            index=models.Index(fields=['term', 'recipe'], name='recipes_sea_term_0f42c5_idx'),
+        ),
+    ]
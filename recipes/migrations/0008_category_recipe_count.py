@@ -0,0 +1,29 @@
+# Generated by Django 3.0.5 on 2026-10-18 13:19
+
+from django.db import migrations, models
+from django.db.models.functions import Coalesce
+
+
+def count_recipes(apps, schema_editor):
+    Category = apps.get_model('recipes', 'Category')
+    Recipe = apps.get_model('recipes', 'Recipe')
+    count = Recipe.categories.through.objects.filter(
+        category=models.OuterRef('pk')
+    ).values('category').annotate(count=models.Count('*')).values('count')
+    Category.objects.update(recipe_count=Coalesce(models.Subquery(count), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0007_searchterm'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='category',
+            name='recipe_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(count_recipes, migrations.RunPython.noop),
+    ]
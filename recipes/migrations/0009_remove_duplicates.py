@@ -0,0 +1,59 @@
+# Generated by Django 3.0.5 on 2026-10-18 13:19
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+from django.db.models.functions import Coalesce
+
+
+def remove_duplicates(apps, schema_editor):
+    '''
+    The spider used to store some rows more than once, keep the first one of
+    them before adding the unique constraints.
+    '''
+    Category = apps.get_model('recipes', 'Category')
+    CookingStep = apps.get_model('recipes', 'CookingStep')
+    Recipe = apps.get_model('recipes', 'Recipe')
+    RecipeCategory = Recipe.categories.through
+
+    duplicates = CookingStep.objects.values('recipe', 'order').annotate(
+        first=Min('id'), count=Count('id')).filter(count__gt=1)
+    for row in duplicates:
+        CookingStep.objects.filter(recipe=row['recipe'], order=row['order']).exclude(
+            id=row['first']).delete()
+
+    duplicates = Recipe.objects.exclude(origin_id=None).values('origin_id').annotate(
+        first=Min('id'), count=Count('id')).filter(count__gt=1)
+    for row in duplicates:
+        Recipe.objects.filter(origin_id=row['origin_id']).exclude(
+            id=row['first']).delete()
+
+    duplicates = Category.objects.exclude(title_fa=None).values('title_fa').annotate(
+        first=Min('id'), count=Count('id')).filter(count__gt=1)
+    for row in duplicates:
+        others = Category.objects.filter(title_fa=row['title_fa']).exclude(
+            id=row['first'])
+        # move recipes of the duplicated categories to the first one
+        links = RecipeCategory.objects.filter(category__in=others)
+        recipe_ids = set(links.values_list('recipe_id', flat=True)) - set(
+            RecipeCategory.objects.filter(category_id=row['first']).values_list(
+                'recipe_id', flat=True))
+        RecipeCategory.objects.bulk_create([
+            RecipeCategory(recipe_id=recipe_id, category_id=row['first'])
+            for recipe_id in recipe_ids])
+        others.delete()
+
+    count = RecipeCategory.objects.filter(
+        category=models.OuterRef('pk')
+    ).values('category').annotate(count=models.Count('*')).values('count')
+    Category.objects.update(recipe_count=Coalesce(models.Subquery(count), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0008_category_recipe_count'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicates, migrations.RunPython.noop),
+    ]
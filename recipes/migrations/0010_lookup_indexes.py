@@ -0,0 +1,36 @@
+# Generated by Django 3.0.5 on 2026-10-18 13:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0009_remove_duplicates'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='author',
+            name='title_en',
+            field=models.CharField(db_index=True, max_length=250, null=True),
+        ),
+        migrations.AlterField(
+            model_name='category',
+            name='title_fa',
+            field=models.CharField(max_length=100, null=True, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='recipe',
+            name='origin_id',
+            field=models.CharField(max_length=250, null=True, unique=True),
+        ),
+        migrations.AddIndex(
+            model_name='recipe',
+            index=models.Index(fields=['published_date', 'id'], name='recipes_rec_publish_0ccca8_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='cookingstep',
+            constraint=models.UniqueConstraint(fields=('recipe', 'order'), name='unique_recipe_step_order'),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 3.0.5 on 2026-10-18 13:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0010_lookup_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CrawlState',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('spider', models.CharField(max_length=100, unique=True)),
+                ('watermark', models.DateTimeField(null=True)),
+                ('finished_date', models.DateTimeField(null=True)),
+            ],
+        ),
+    ]
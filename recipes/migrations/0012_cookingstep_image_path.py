@@ -0,0 +1,18 @@
+# Generated by Django 3.0.5 on 2026-10-18 13:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0011_crawlstate'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cookingstep',
+            name='image_path',
+            field=models.CharField(blank=True, max_length=100, null=True),
+        ),
+    ]
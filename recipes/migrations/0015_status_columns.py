@@ -0,0 +1,65 @@
+# Generated by Django 3.0.5 on 2026-10-18 13:42
+
+from django.db import migrations, models
+from django.db.models.functions import Coalesce
+
+
+def update_status(apps, schema_editor):
+    CookingStep = apps.get_model('recipes', 'CookingStep')
+    Recipe = apps.get_model('recipes', 'Recipe')
+    empty = models.Q(description_fa__in=['', '-']) | models.Q(description_fa=None)
+    CookingStep.objects.update(is_empty=models.Case(
+        models.When(empty, then=models.Value(True)),
+        default=models.Value(False), output_field=models.BooleanField()))
+
+    def recipe_steps(condition):
+        return CookingStep.objects.filter(condition, recipe=models.OuterRef('pk'))
+
+    smiley = (models.Q(image__icontains='smiles')
+              | models.Q(image__icontains='emoticon')
+              | models.Q(image__icontains='cheesebuerger.de/'))
+    manually_translatable = (models.Q(description_fa__contains='teaspoon')
+                             | models.Q(description_fa__contains='tsp')
+                             | models.Q(description_fa__contains='tbsp')
+                             | models.Q(description_fa__contains='tablespoon')
+                             | models.Q(description_fa__contains='gr')
+                             | models.Q(description_fa__contains='cup'))
+    untranslated = (models.Q(description_en='')
+                    & ~models.Q(description_fa__in=['', '-']))
+    count = recipe_steps(untranslated).values('recipe').annotate(
+        count=models.Count('*')).values('count')
+    Recipe.objects.update(
+        has_smilies=models.Exists(recipe_steps(smiley)),
+        manually_translatable=models.Exists(recipe_steps(manually_translatable)),
+        untranslated_step_count=Coalesce(models.Subquery(count), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0014_job'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cookingstep',
+            name='is_empty',
+            field=models.BooleanField(db_index=True, default=False),
+        ),
+        migrations.AddField(
+            model_name='recipe',
+            name='has_smilies',
+            field=models.BooleanField(db_index=True, default=False),
+        ),
+        migrations.AddField(
+            model_name='recipe',
+            name='manually_translatable',
+            field=models.BooleanField(db_index=True, default=False),
+        ),
+        migrations.AddField(
+            model_name='recipe',
+            name='untranslated_step_count',
+            field=models.IntegerField(db_index=True, default=0),
+        ),
+        migrations.RunPython(update_status, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 3.0.5 on 2026-10-18 14:14
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0015_status_columns'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='recipe',
+            name='crowled_date',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
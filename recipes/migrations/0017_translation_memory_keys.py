@@ -0,0 +1,29 @@
+import hashlib
+
+from django.db import migrations
+
+
+def update_keys(apps, schema_editor):
+    '''
+    The keys were made from search.normalize() of the source text, they are
+    made again by the conservative normalization of recipes.translation.
+    '''
+    TranslationMemory = apps.get_model('recipes', 'TranslationMemory')
+    characters = str.maketrans({'ي': 'ی', 'ك': 'ک', '\u200c': None})
+    memories = list(TranslationMemory.objects.only('target', 'source_text'))
+    for memory in memories:
+        normalized = ' '.join(memory.source_text.translate(characters).split())
+        memory.key = hashlib.sha256(
+            ('%s:%s' % (memory.target, normalized)).encode('utf-8')).hexdigest()
+    TranslationMemory.objects.bulk_update(memories, ['key'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0016_crowled_date_default'),
+    ]
+
+    operations = [
+        migrations.RunPython(update_keys, migrations.RunPython.noop),
+    ]
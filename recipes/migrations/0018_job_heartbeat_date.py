@@ -0,0 +1,24 @@
+from django.db import migrations, models
+from django.db.models import F
+
+
+def set_heartbeats(apps, schema_editor):
+    # Running jobs are taken again by the age of their heartbeat now
+    Job = apps.get_model('recipes', 'Job')
+    Job.objects.filter(status='running').update(heartbeat_date=F('started_date'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0017_translation_memory_keys'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='heartbeat_date',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.RunPython(set_heartbeats, migrations.RunPython.noop),
+    ]
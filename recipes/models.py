@@ -1,22 +1,32 @@
+from django.conf import settings
 from django.db import models
+from django.db.models.functions import Coalesce
 from django.utils import timezone
 from django.utils.safestring import mark_safe
 
+from .cache import ContentVersionQuerySet
+
 
 class Author(models.Model):
     title_fa = models.CharField(max_length=250, null=True)
-    title_en = models.CharField(max_length=250, null=True)
+    title_en = models.CharField(max_length=250, null=True, db_index=True)
     website = models.URLField(null=True)
     email = models.EmailField(null=True)
     image = models.URLField(max_length=300, null=True)
 
+    objects = ContentVersionQuerySet.as_manager()
+
     def __str__(self):
         return self.title_en
 
 
 class Category(models.Model):
-    title_fa = models.CharField(max_length=100, null=True)
+    title_fa = models.CharField(max_length=100, null=True, unique=True)
     title_en = models.CharField(max_length=100, null=True)
+    # Denormalized number of recipes, see update_recipe_count()
+    recipe_count = models.IntegerField(default=0)
+
+    objects = ContentVersionQuerySet.as_manager()
 
     def __str__(self):
         # TODO: regarding to the site language translate the title
@@ -24,19 +34,150 @@ class Category(models.Model):
             return self.title_en
         return self.title_fa
 
+    @classmethod
+    def update_recipe_count(cls, category_ids=None):
+        '''
+        Recount the recipes of the given categories (all of them by default)
+        with one UPDATE statement. It is called whenever recipes are added to
+        or removed from categories (see recipes.signals).
+        '''
+        through = Recipe.categories.through
+        count = through.objects.filter(
+            category=models.OuterRef('pk')
+        ).values('category').annotate(count=models.Count('*')).values('count')
+        categories = cls.objects.all()
+        if category_ids is not None:
+            categories = categories.filter(pk__in=category_ids)
+        categories.update(recipe_count=Coalesce(models.Subquery(count), 0))
+
+
+# Cooking steps which still need a translation: steps with no english
+# description, except the ones which have no persian description either
+UNTRANSLATED_STEP = (models.Q(description_en='')
+                     & ~models.Q(description_fa__in=['', '-']))
+# Cooking steps with no description
+EMPTY_STEP = models.Q(description_fa__in=['', '-']) | models.Q(description_fa=None)
+# Cooking steps which have a smiley as their image (see recipes.content.SMILEY)
+SMILEY_STEP = (models.Q(image__icontains='smiles')
+               | models.Q(image__icontains='emoticon')
+               | models.Q(image__icontains='cheesebuerger.de/'))
+# Cooking steps which have the english units in their description, so the
+# recipe can be translated by hand instead of the translation API
+MANUALLY_TRANSLATABLE_STEP = (models.Q(description_fa__contains='teaspoon')
+                              | models.Q(description_fa__contains='tsp')
+                              | models.Q(description_fa__contains='tbsp')
+                              | models.Q(description_fa__contains='tablespoon')
+                              | models.Q(description_fa__contains='gr')
+                              | models.Q(description_fa__contains='cup'))
+
+# Thumbnails of the step images: name -> (width, height). They are made by the
+# spider (scrapy_app.pipelines.StepImagesPipeline uses them as IMAGES_THUMBS),
+# 'small' is shown in the admin and 'medium' is the thumbnail of the API.
+THUMBNAIL_SIZES = {'small': (100, 100), 'medium': (400, 400)}
+
+
+class RecipeQuerySet(ContentVersionQuerySet):
+    def with_related(self, author=True, categories=True, steps=True,
+                     step_fields=None):
+        '''
+        Load everything RecipeSerializer needs in a fixed number of queries:
+        author is joined, categories and steps are prefetched. Steps are kept
+        ordered in the "ordered_steps" attribute of each recipe.
+        Relations which are not needed can be turned off, and step_fields
+        limits the columns loaded for the cooking steps.
+        '''
+        queryset = self
+        if author:
+            queryset = queryset.select_related('author')
+        if categories:
+            queryset = queryset.prefetch_related('categories')
+        if steps:
+            steps_queryset = CookingStep.objects.order_by('order')
+            if step_fields is not None:
+                steps_queryset = steps_queryset.only(
+                    'recipe', 'order', *step_fields)
+            queryset = queryset.prefetch_related(models.Prefetch(
+                'steps', queryset=steps_queryset, to_attr='ordered_steps'))
+        return queryset
+
+    def with_untranslated_steps(self):
+        '''
+        Annotate the number of untranslated cooking steps of each recipe
+        (untranslated_steps), counted by a subquery in the database.
+        '''
+        count = CookingStep.objects.filter(
+            UNTRANSLATED_STEP, recipe=models.OuterRef('pk')
+        ).values('recipe').annotate(count=models.Count('*')).values('count')
+        return self.annotate(
+            untranslated_steps=Coalesce(models.Subquery(count), 0))
+
+    def update_translated_state(self):
+        '''
+        Mark the recipes whose title and all cooking steps are translated, with
+        one UPDATE statement. Returns the number of updated recipes.
+        '''
+        queryset = self.filter(translated=False).exclude(title_en='')
+        return queryset.with_untranslated_steps().filter(
+            untranslated_steps=0).update(translated=True)
+
 
 class Recipe (models.Model):
-    origin_id = models.CharField(max_length=250, null=True)
+    origin_id = models.CharField(max_length=250, null=True, unique=True)
     title_fa = models.CharField(max_length=250, null=True)
     title_en = models.CharField(max_length=250, null=True)
     self_link = models.URLField(null=True)
     alternate_link = models.URLField(null=True)
     published_date = models.DateTimeField(null=True)
     updated_date = models.DateTimeField(null=True)
-    crowled_date = models.DateTimeField(default=timezone.now())
+    crowled_date = models.DateTimeField(default=timezone.now)
     author = models.ForeignKey('Author', on_delete=models.CASCADE)
     categories = models.ManyToManyField('Category',)
     translated = models.BooleanField(default=False,)
+    # Status of the cooking steps for the admin filters, see update_status()
+    has_smilies = models.BooleanField(default=False, db_index=True)
+    manually_translatable = models.BooleanField(default=False, db_index=True)
+    untranslated_step_count = models.IntegerField(default=0, db_index=True)
+
+    objects = RecipeQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # ordering and keyset pagination of the recipe lists
+            models.Index(fields=['published_date', 'id'])
+        ]
+
+    @classmethod
+    def update_status(cls, recipe_ids=None, steps=True):
+        '''
+        Update the status columns of the given recipes (all of them by
+        default) from their cooking steps: has_smilies, manually_translatable,
+        untranslated_step_count and is_empty of the steps (unless steps is
+        False), with one UPDATE statement for each table. Returns the number
+        of updated recipes.
+        Saving or deleting a cooking step updates its recipe (see
+        recipes.signals), bulk changes of steps must call it themselves.
+        '''
+        recipes = cls.objects.all()
+        if recipe_ids is not None:
+            recipes = recipes.filter(pk__in=recipe_ids)
+        if steps:
+            step_queryset = CookingStep.objects.all()
+            if recipe_ids is not None:
+                step_queryset = step_queryset.filter(recipe__in=recipe_ids)
+            step_queryset.update(is_empty=models.Case(
+                models.When(EMPTY_STEP, then=models.Value(True)),
+                default=models.Value(False), output_field=models.BooleanField()))
+
+        def recipe_steps(condition):
+            return CookingStep.objects.filter(condition, recipe=models.OuterRef('pk'))
+
+        untranslated = recipe_steps(UNTRANSLATED_STEP).values('recipe').annotate(
+            count=models.Count('*')).values('count')
+        return recipes.update(
+            has_smilies=models.Exists(recipe_steps(SMILEY_STEP)),
+            manually_translatable=models.Exists(
+                recipe_steps(MANUALLY_TRANSLATABLE_STEP)),
+            untranslated_step_count=Coalesce(models.Subquery(untranslated), 0))
 
     def __str__(self):
         if self.title_en is not None and self.title_en != "":
@@ -53,22 +194,137 @@ class CookingStep(models.Model):
     resources as the original site uses.
     '''
     image = models.URLField(max_length=300, null=True)
+    # Downloaded copy of the image, relative to IMAGES_STORE of the spider
+    # (see scrapy_app.pipelines.StepImagesPipeline)
+    image_path = models.CharField(max_length=100, null=True, blank=True)
     description_fa = models.TextField(null=True)
     description_en = models.TextField(null=True, blank=True)
+    # No persian description, see EMPTY_STEP
+    is_empty = models.BooleanField(default=False, db_index=True)
     order = models.IntegerField(null=False)
     recipe = models.ForeignKey(
         'Recipe', related_name='steps', on_delete=models.CASCADE)
 
-    # class Meta:
-    #     indexes = [
-    #         models.index(fields=[''])
-    #     ]
+    objects = ContentVersionQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['recipe', 'order'],
+                                    name='unique_recipe_step_order')
+        ]
 
     def __str__(self):
         title = "%s - Step %d" % (self.recipe.title_fa, self.order)
         return title
 
+    def get_image_url(self, size=None):
+        '''
+        URL of the downloaded image or of its thumbnail (size: a name of
+        THUMBNAIL_SIZES, ValueError for other names).
+        The original url is returned if the image is not downloaded yet or
+        RECIPES_IMAGES_URL (where IMAGES_STORE is served) is not set.
+        '''
+        if size is not None and size not in THUMBNAIL_SIZES:
+            raise ValueError('Unknown thumbnail size: %r' % size)
+        base_url = getattr(settings, 'RECIPES_IMAGES_URL', None)
+        if not self.image_path or not base_url:
+            return self.image
+        path = self.image_path
+        if size is not None:
+            path = path.replace('full/', 'thumbs/%s/' % size, 1)
+        return base_url + path
+
     def image_show_thumbnail(self):
         return mark_safe(u'<a href="%s" target="_blank">'
                          '<img src="%s" width="%d" alt="%s" />'
                          '</a>' % (image_url, image_url, image_width, file_name))
+
+
+class SearchTerm(models.Model):
+    '''
+    Inverted index for searching recipes, see recipes.search.
+    Terms of the titles are stored with step=None, terms of cooking steps keep
+    a reference to their step, so each one can be re-indexed on its own.
+    '''
+    term = models.CharField(max_length=100)
+    weight = models.IntegerField(default=1)
+    recipe = models.ForeignKey(
+        'Recipe', related_name='search_terms', on_delete=models.CASCADE)
+    step = models.ForeignKey(
+        'CookingStep', related_name='search_terms', null=True,
+        on_delete=models.CASCADE)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['term', 'recipe'])
+        ]
+
+    def __str__(self):
+        return self.term
+
+
+class CrawlState(models.Model):
+    '''
+    Watermark of the last finished crawl of each spider. The recipe spider only
+    asks the feed for posts updated after the watermark (incremental crawl).
+    '''
+    spider = models.CharField(max_length=100, unique=True)
+    watermark = models.DateTimeField(null=True)
+    finished_date = models.DateTimeField(null=True)
+
+    def __str__(self):
+        return self.spider
+
+
+class TranslationMemory(models.Model):
+    '''
+    Translations received from the translation API, they are used instead of
+    calling the API again for the same text (see recipes.translation).
+    key is the hash of the target language and the normalized source text.
+    '''
+    key = models.CharField(max_length=64, unique=True)
+    target = models.CharField(max_length=10)
+    source_text = models.TextField()
+    translation = models.TextField()
+    hits = models.IntegerField(default=0)
+    created_date = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.source_text
+
+
+class Job(models.Model):
+    '''
+    A chunk of an admin action which runs in the background, see recipes.jobs.
+    Jobs of one run of an action have the same group.
+    '''
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [(PENDING, 'Pending'), (RUNNING, 'Running'),
+                      (DONE, 'Done'), (FAILED, 'Failed')]
+
+    task = models.CharField(max_length=100)
+    group = models.CharField(max_length=32, db_index=True)
+    # JSON list of the primary keys of the objects
+    object_ids = models.TextField()
+    object_count = models.IntegerField(default=0)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES,
+                              default=PENDING)
+    result = models.TextField(blank=True)
+    error = models.TextField(blank=True)
+    created_date = models.DateTimeField(auto_now_add=True)
+    started_date = models.DateTimeField(null=True)
+    # updated by the worker while the job is running
+    heartbeat_date = models.DateTimeField(null=True)
+    finished_date = models.DateTimeField(null=True)
+
+    class Meta:
+        indexes = [
+            # the worker takes the oldest pending job
+            models.Index(fields=['status', 'id'])
+        ]
+
+    def __str__(self):
+        return '%s #%d' % (self.task, self.pk)
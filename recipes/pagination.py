@@ -0,0 +1,124 @@
+from base64 import b64decode, b64encode
+from collections import OrderedDict
+from urllib import parse
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class RecipeCursorPagination(BasePagination):
+    '''
+    Keyset (cursor) pagination for recipes, keyed on (published_date, id).
+    Each page is fetched with a "WHERE (published_date, id) < cursor" filter,
+    so there is no OFFSET scan and recipes which are added by the spider while
+    a client is paging do not shift the following pages.
+    The cursor is an opaque base64 string, the page size can be configured with
+    RECIPES_PAGE_SIZE in settings and by the client with "page_size".
+    NOTE: Recipes without published_date can not be positioned and are skipped.
+    '''
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    page_size = getattr(settings, 'RECIPES_PAGE_SIZE', 20)
+    max_page_size = getattr(settings, 'RECIPES_MAX_PAGE_SIZE', 100)
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.cursor = self.decode_cursor(request)
+
+        queryset = queryset.filter(published_date__isnull=False)
+        if self.cursor is None:
+            reverse = False
+            queryset = queryset.order_by('-published_date', '-id')
+        else:
+            reverse, published_date, pk = self.cursor
+            if reverse:
+                queryset = queryset.filter(
+                    Q(published_date__gt=published_date)
+                    | Q(published_date=published_date, id__gt=pk)
+                ).order_by('published_date', 'id')
+            else:
+                queryset = queryset.filter(
+                    Q(published_date__lt=published_date)
+                    | Q(published_date=published_date, id__lt=pk)
+                ).order_by('-published_date', '-id')
+
+        # Fetch one extra item to find out if there is another page or not
+        results = list(queryset[:self.page_size + 1])
+        has_more = len(results) > self.page_size
+        self.page = results[:self.page_size]
+
+        if reverse:
+            self.page.reverse()
+            self.has_next = True
+            self.has_previous = has_more
+        else:
+            self.has_next = has_more
+            self.has_previous = self.cursor is not None
+        return self.page
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        if page_size <= 0:
+            return self.page_size
+        return min(page_size, self.max_page_size)
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        last = self.page[-1]
+        return self.encode_cursor(False, last.published_date, last.pk)
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        if not self.page:
+            url = self.request.build_absolute_uri()
+            return remove_query_param(url, self.cursor_query_param)
+        first = self.page[0]
+        return self.encode_cursor(True, first.published_date, first.pk)
+
+    def decode_cursor(self, request):
+        '''
+        Returns (reverse, published_date, id) of the cursor or None for the
+        first page. Raise NotFound if the cursor is tampered.
+        '''
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+        try:
+            querystring = b64decode(encoded.encode('ascii')).decode('ascii')
+            tokens = parse.parse_qs(querystring, keep_blank_values=True)
+            reverse = bool(int(tokens.get('r', ['0'])[0]))
+            published_date = parse_datetime(tokens['p'][0])
+            pk = int(tokens['i'][0])
+        except (TypeError, ValueError, KeyError, UnicodeError):
+            raise NotFound(self.invalid_cursor_message)
+        if published_date is None:
+            raise NotFound(self.invalid_cursor_message)
+        return reverse, published_date, pk
+
+    def encode_cursor(self, reverse, published_date, pk):
+        tokens = {'p': published_date.isoformat(), 'i': pk}
+        if reverse:
+            tokens['r'] = '1'
+        querystring = parse.urlencode(tokens, doseq=True)
+        encoded = b64encode(querystring.encode('ascii')).decode('ascii')
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, encoded)
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data)
+        ]))
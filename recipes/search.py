@@ -0,0 +1,265 @@
+'''
+A small full-text search engine for recipes.
+Titles and cooking step descriptions (Persian and English) are normalized,
+tokenized and stored in an inverted index (SearchTerm model). The index is
+updated incrementally whenever a recipe or a cooking step is saved (see
+recipes.signals), so the spider pipeline and admin edits keep it fresh.
+The whole index can be rebuilt by "python manage.py rebuild_search_index".
+'''
+import re
+from collections import Counter
+
+from django.db import transaction
+from django.db.models import Count, Sum
+
+from .models import CookingStep, Recipe, SearchTerm
+
+# Weight of a term regarding to where it is found
+TITLE_WEIGHT = 5
+STEP_WEIGHT = 1
+
+MAX_TERM_LENGTH = 100
+
+PERSIAN_CHARACTERS = str.maketrans({
+    'ي': 'ی', 'ى': 'ی', 'ئ': 'ی',
+    'ك': 'ک',
+    'ة': 'ه', 'ۀ': 'ه',
+    'أ': 'ا', 'إ': 'ا', 'آ': 'ا', 'ٱ': 'ا',
+    'ؤ': 'و',
+    '۰': '0', '۱': '1', '۲': '2', '۳': '3', '۴': '4',
+    '۵': '5', '۶': '6', '۷': '7', '۸': '8', '۹': '9',
+    '٠': '0', '١': '1', '٢': '2', '٣': '3', '٤': '4',
+    '٥': '5', '٦': '6', '٧': '7', '٨': '8', '٩': '9',
+})
+
+# zero width non-joiner/joiner/space, tatweel and arabic diacritics
+IGNORED_CHARACTERS = re.compile('[\u200b-\u200d\ufeff\u0640\u064b-\u065f\u0670]')
+TOKEN = re.compile(r'[^\W_]+')
+
+STOP_WORDS = {
+    # Persian
+    'و', 'در', 'به', 'از', 'که', 'را', 'با', 'این', 'ان', 'تا', 'یا', 'هم',
+    'برای', 'یک', 'می', 'شود', 'کنید', 'است',
+    # English
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'in',
+    'into', 'is', 'it', 'of', 'on', 'or', 'the', 'to', 'with',
+}
+
+
+def normalize(text):
+    '''
+    Normalize Persian letters (ي -> ی, ك -> ک, ...) and digits, remove the
+    zero width non-joiner and diacritics, and lower the english letters.
+    NOTE: Removing the ZWNJ makes "می‌پزیم" and "میپزیم" the same word, as
+    users type both of them.
+    '''
+    text = text.translate(PERSIAN_CHARACTERS)
+    text = IGNORED_CHARACTERS.sub('', text)
+    return text.lower()
+
+
+VOWELS = 'aeiou'
+
+
+def _is_consonant(word, i):
+    if word[i] in VOWELS:
+        return False
+    if word[i] == 'y':
+        return i == 0 or not _is_consonant(word, i - 1)
+    return True
+
+
+def _measure(stem):
+    # number of vowel-consonant sequences in the stem (m in Porter algorithm)
+    forms = ''.join('c' if _is_consonant(stem, i) else 'v'
+                    for i in range(len(stem)))
+    return len(re.findall('vc', re.sub(r'(.)\1+', r'\1', forms)))
+
+
+def _has_vowel(stem):
+    return any(not _is_consonant(stem, i) for i in range(len(stem)))
+
+
+def _ends_cvc(stem):
+    return (len(stem) >= 3 and _is_consonant(stem, -3)
+            and not _is_consonant(stem, -2) and _is_consonant(stem, -1)
+            and stem[-1] not in 'wxy')
+
+
+def stem_english(word):
+    '''
+    Step 1 of the Porter stemmer: plurals, -ed and -ing.
+    It is enough for recipes e.g. "cakes" -> "cake", "baking" -> "bake",
+    "chopped" -> "chop".
+    '''
+    if len(word) <= 3:
+        return word
+    # Step 1a
+    if word.endswith('sses'):
+        word = word[:-2]
+    elif word.endswith('ies'):
+        word = word[:-2]
+    elif word.endswith('s') and not word.endswith('ss') and not word.endswith('us'):
+        word = word[:-1]
+    # Step 1b
+    if word.endswith('eed'):
+        if _measure(word[:-3]) > 0:
+            word = word[:-1]
+    else:
+        for suffix in ('ed', 'ing'):
+            stem = word[:-len(suffix)]
+            if word.endswith(suffix) and _has_vowel(stem):
+                if stem.endswith(('at', 'bl', 'iz')):
+                    word = stem + 'e'
+                elif (len(stem) > 1 and stem[-1] == stem[-2]
+                      and _is_consonant(stem, -1) and stem[-1] not in 'lsz'):
+                    word = stem[:-1]
+                elif _measure(stem) == 1 and _ends_cvc(stem):
+                    word = stem + 'e'
+                else:
+                    word = stem
+                break
+    # Step 1c
+    if word.endswith('y') and _has_vowel(word[:-1]):
+        word = word[:-1] + 'i'
+    return word
+
+
+def tokenize(text):
+    '''
+    Returns the list of normalized index terms of the text.
+    '''
+    if not text:
+        return []
+    terms = []
+    for token in TOKEN.findall(normalize(text)):
+        if token in STOP_WORDS:
+            continue
+        if token.isascii() and token.isalpha():
+            token = stem_english(token)
+        terms.append(token[:MAX_TERM_LENGTH])
+    return terms
+
+
+def _build_terms(recipe_id, step_id, texts, weight):
+    counts = Counter()
+    for text in texts:
+        counts.update(tokenize(text))
+    return [SearchTerm(term=term, recipe_id=recipe_id, step_id=step_id,
+                       weight=count * weight)
+            for term, count in counts.items()]
+
+
+def _recipe_terms(recipe):
+    return _build_terms(recipe.pk, None, [recipe.title_fa, recipe.title_en],
+                        TITLE_WEIGHT)
+
+
+def _step_terms(step):
+    return _build_terms(step.recipe_id, step.pk,
+                        [step.description_fa, step.description_en], STEP_WEIGHT)
+
+
+def index_recipe(recipe):
+    '''
+    Index the titles of the recipe.
+    '''
+    with transaction.atomic():
+        SearchTerm.objects.filter(recipe_id=recipe.pk, step=None).delete()
+        SearchTerm.objects.bulk_create(_recipe_terms(recipe))
+
+
+def index_step(step):
+    '''
+    Index the descriptions of the cooking step.
+    '''
+    with transaction.atomic():
+        SearchTerm.objects.filter(step_id=step.pk).delete()
+        SearchTerm.objects.bulk_create(_step_terms(step))
+
+
+def index_new(recipes=(), steps=()):
+    '''
+    Index recipes and steps which are not indexed yet with one bulk insert,
+    e.g. rows which are created by bulk_create() and send no signals.
+    '''
+    terms = []
+    for recipe in recipes:
+        terms += _recipe_terms(recipe)
+    for step in steps:
+        terms += _step_terms(step)
+    SearchTerm.objects.bulk_create(terms)
+
+
+def index_rows(recipes=(), steps=()):
+    '''
+    The same as index_new() for the values of rows instead of model instances:
+    (pk, title_fa, title_en) of recipes and (pk, recipe_id, description_fa,
+    description_en) of cooking steps, e.g. from values_list(). The terms are
+    inserted in the largest batches the database allows.
+    '''
+    terms = []
+    for pk, title_fa, title_en in recipes:
+        terms += _build_terms(pk, None, [title_fa, title_en], TITLE_WEIGHT)
+    for pk, recipe_id, description_fa, description_en in steps:
+        terms += _build_terms(recipe_id, pk, [description_fa, description_en],
+                              STEP_WEIGHT)
+    SearchTerm.objects.bulk_create(terms)
+
+
+def reindex(objects):
+    '''
+    Index recipes (titles) and cooking steps again with one delete and one bulk
+    insert, e.g. after they are changed by bulk_update().
+    '''
+    recipes = [obj for obj in objects if isinstance(obj, Recipe)]
+    steps = [obj for obj in objects if isinstance(obj, CookingStep)]
+    with transaction.atomic():
+        if recipes:
+            SearchTerm.objects.filter(
+                recipe__in=[recipe.pk for recipe in recipes], step=None).delete()
+        if steps:
+            SearchTerm.objects.filter(step__in=[step.pk for step in steps]).delete()
+        index_new(recipes, steps)
+
+
+def rebuild_index(batch_size=500):
+    '''
+    Rebuild the whole index, returns the number of indexed terms.
+    '''
+    total = 0
+    with transaction.atomic():
+        SearchTerm.objects.all().delete()
+        batch = []
+        recipes = Recipe.objects.only('title_fa', 'title_en')
+        for recipe in recipes.iterator(chunk_size=batch_size):
+            batch += _recipe_terms(recipe)
+            if len(batch) >= batch_size:
+                total += len(SearchTerm.objects.bulk_create(batch))
+                batch = []
+        steps = CookingStep.objects.only(
+            'recipe', 'description_fa', 'description_en')
+        for step in steps.iterator(chunk_size=batch_size):
+            batch += _step_terms(step)
+            if len(batch) >= batch_size:
+                total += len(SearchTerm.objects.bulk_create(batch))
+                batch = []
+        total += len(SearchTerm.objects.bulk_create(batch))
+    return total
+
+
+def search(query, limit=20):
+    '''
+    Returns the ids of the best matching recipes.
+    Recipes which match more words of the query come first, then the sum of
+    the weights (title matches count more than step matches) decides.
+    '''
+    terms = list(set(tokenize(query)))
+    if not terms:
+        return []
+    ranking = (SearchTerm.objects
+               .filter(term__in=terms)
+               .values('recipe')
+               .annotate(matched=Count('term', distinct=True), score=Sum('weight'))
+               .order_by('-matched', '-score', '-recipe'))
+    return [row['recipe'] for row in ranking[:limit]]
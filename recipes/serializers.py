@@ -2,35 +2,97 @@ from rest_framework import serializers
 
 from .models import Author, Category, CookingStep, Recipe
 
+LANGUAGES = ('fa', 'en')
 
-class AuthorSerializer(serializers.ModelSerializer):
+
+class LanguageFieldsMixin(object):
+    '''
+    If "lang" is set in the serializer context (fa or en), the fields of the
+    other language (title_en, description_fa, ...) are dropped.
+    '''
+
+    def get_fields(self):
+        fields = super().get_fields()
+        lang = self.context.get('lang')
+        if lang in LANGUAGES:
+            for other in LANGUAGES:
+                if other == lang:
+                    continue
+                for name in list(fields):
+                    if name.endswith('_' + other):
+                        fields.pop(name)
+        return fields
+
+
+class AuthorSerializer(LanguageFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = Author
         fields = ['title_fa', 'title_en']
 
 
-class CategorySerializer(serializers.ModelSerializer):
+class CategorySerializer(LanguageFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = Category
         fields = ['title_fa', 'title_en']
 
 
-class CookingStepSerializer(serializers.ModelSerializer):
+class CategoryCountSerializer(CategorySerializer):
+    class Meta:
+        model = Category
+        fields = ['id', 'title_fa', 'title_en', 'recipe_count']
+
+
+class CookingStepSerializer(LanguageFieldsMixin, serializers.ModelSerializer):
+    '''
+    The downloaded copy of the image is sent if it is available.
+    '''
+    image = serializers.SerializerMethodField()
+
     class Meta:
         model = CookingStep
         fields = ['order', 'image', 'description_fa', 'description_en']
 
+    def get_image(self, instance):
+        return instance.get_image_url()
+
 
-class RecipeSerializer(serializers.ModelSerializer):
+class RecipeSerializer(LanguageFieldsMixin, serializers.ModelSerializer):
+    '''
+    A subset of fields can be requested by "fields" in the serializer context
+    (sparse fieldsets), e.g. ['id', 'title_fa', 'thumbnail'] for list screens.
+    '''
     author = AuthorSerializer(many=False)
     categories = CategorySerializer(many=True)
+    thumbnail = serializers.SerializerMethodField()
     steps = serializers.SerializerMethodField()
 
     class Meta:
         model = Recipe
-        fields = ['title_fa', 'title_en',
-                  'published_date', 'translated', 'author', 'categories', 'steps']
+        fields = ['id', 'title_fa', 'title_en', 'published_date', 'translated',
+                  'author', 'categories', 'thumbnail', 'steps']
+
+    def get_fields(self):
+        fields = super().get_fields()
+        requested = self.context.get('fields')
+        if requested:
+            for name in list(fields):
+                if name not in requested:
+                    fields.pop(name)
+        return fields
+
+    def get_ordered_steps(self, instance):
+        # Use the steps prefetched by Recipe.objects.with_related() if available
+        steps = getattr(instance, 'ordered_steps', None)
+        if steps is None:
+            steps = instance.steps.all().order_by('order')
+        return steps
+
+    def get_thumbnail(self, instance):
+        # The image of the first cooking step
+        for step in self.get_ordered_steps(instance):
+            return step.get_image_url('medium')
+        return None
 
     def get_steps(self, instance):
-        steps = instance.steps.all().order_by('order')
-        return CookingStepSerializer(steps, many=True).data
+        steps = self.get_ordered_steps(instance)
+        return CookingStepSerializer(steps, many=True, context=self.context).data
@@ -0,0 +1,103 @@
+import threading
+from contextlib import contextmanager
+
+from django.db.models.signals import (m2m_changed, post_delete, post_save,
+                                      pre_delete, pre_save)
+from django.dispatch import receiver
+
+from . import search
+from .cache import bump_content_version
+from .models import Author, Category, CookingStep, Recipe
+
+_status = threading.local()
+
+
+@receiver(post_save, sender=Author)
+@receiver(post_save, sender=Category)
+@receiver(post_save, sender=Recipe)
+@receiver(post_save, sender=CookingStep)
+@receiver(post_delete, sender=Author)
+@receiver(post_delete, sender=Category)
+@receiver(post_delete, sender=Recipe)
+@receiver(post_delete, sender=CookingStep)
+def invalidate_recipes_cache(sender, **kwargs):
+    '''
+    Any change in the recipes content makes the cached API responses stale.
+    '''
+    bump_content_version()
+
+
+@receiver(m2m_changed, sender=Recipe.categories.through)
+def invalidate_recipes_cache_on_categories(sender, action, **kwargs):
+    if action.startswith('post_'):
+        bump_content_version()
+
+
+@receiver(post_save, sender=Recipe)
+def update_recipe_search_index(sender, instance, raw=False, **kwargs):
+    if not raw:
+        search.index_recipe(instance)
+
+
+@receiver(post_save, sender=CookingStep)
+def update_step_search_index(sender, instance, raw=False, **kwargs):
+    if not raw:
+        search.index_step(instance)
+
+
+@receiver(m2m_changed, sender=Recipe.categories.through)
+def update_category_recipe_count(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear':
+        # pk_set is None for clear, keep the categories to recount them later
+        if reverse:
+            instance._cleared_category_ids = [instance.pk]
+        else:
+            instance._cleared_category_ids = list(
+                instance.categories.values_list('pk', flat=True))
+    elif action == 'post_clear':
+        Category.update_recipe_count(
+            getattr(instance, '_cleared_category_ids', []))
+    elif action in ('post_add', 'post_remove'):
+        Category.update_recipe_count([instance.pk] if reverse else pk_set)
+
+
+@receiver(pre_delete, sender=Recipe)
+def remember_recipe_categories(sender, instance, **kwargs):
+    # The M2M rows are deleted without any m2m_changed signal
+    instance._deleted_category_ids = list(
+        instance.categories.values_list('pk', flat=True))
+
+
+@receiver(post_delete, sender=Recipe)
+def update_deleted_recipe_categories(sender, instance, **kwargs):
+    category_ids = getattr(instance, '_deleted_category_ids', None)
+    if category_ids:
+        Category.update_recipe_count(category_ids)
+
+
+@receiver(pre_save, sender=CookingStep)
+def update_step_status(sender, instance, **kwargs):
+    # The same as EMPTY_STEP
+    instance.is_empty = instance.description_fa in ('', '-', None)
+
+
+@receiver(post_save, sender=CookingStep)
+@receiver(post_delete, sender=CookingStep)
+def update_recipe_status(sender, instance, raw=False, **kwargs):
+    if not raw and not getattr(_status, 'deferred', False):
+        Recipe.update_status([instance.recipe_id], steps=False)
+
+
+@contextmanager
+def deferred_recipe_status():
+    '''
+    Saving and deleting cooking steps in the block does not update the status
+    of their recipes one by one, the caller runs Recipe.update_status() for
+    all of them at the end.
+    '''
+    deferred = getattr(_status, 'deferred', False)
+    _status.deferred = True
+    try:
+        yield
+    finally:
+        _status.deferred = deferred
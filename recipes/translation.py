@@ -0,0 +1,219 @@
+'''
+Translation of titles and cooking steps.
+TranslationService sends the texts to the backend in batches (as many
+strings in one request as the API accepts) and translates each distinct
+text once, instead of one request per text. The backend is chosen by the
+RECIPES_TRANSLATION_BACKEND setting:
+- recipes.translation.GoogleBackend (default): Google Cloud Translation,
+  one client is created and reused.
+- recipes.translation.FakeBackend: local and deterministic, for tests.
+Every translation is kept in the translation memory (TranslationMemory), and
+texts which are already translated are not sent to the backend again. Texts
+are matched after a conservative normalization (see memory_key), so a text
+typed a bit differently is found too.
+'''
+import hashlib
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, QuerySet
+from django.utils.module_loading import import_string
+
+from . import search
+from .models import CookingStep, Recipe, TranslationMemory
+
+
+class GoogleBackend(object):
+    # Limits of the Translation API (v2) for one request
+    max_batch_strings = 128
+    max_batch_characters = 30000
+
+    def __init__(self):
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            from google.cloud import translate_v2 as translate
+            self._client = translate.Client()
+        return self._client
+
+    def translate(self, texts, target, source=None):
+        # format_='text': the results are not HTML escaped
+        results = self.client.translate(texts, target_language=target,
+                                        source_language=source, format_='text')
+        return [result['translatedText'] for result in results]
+
+
+class FakeBackend(object):
+    '''
+    Translates "text" to "[en] text" and records the requests, for tests.
+    '''
+    max_batch_strings = 128
+    max_batch_characters = 30000
+
+    def __init__(self):
+        self.requests = []
+
+    def translate(self, texts, target, source=None):
+        self.requests.append(list(texts))
+        return ['[%s] %s' % (target, text) for text in texts]
+
+
+# Arabic letters which are typed instead of the Persian ones, and the zero
+# width non-joiner, which is typed or left out in the same words
+MEMORY_CHARACTERS = str.maketrans({'ي': 'ی', 'ك': 'ک', '\u200c': None})
+
+
+def memory_key(text, target):
+    '''
+    Hash of the target language and the source text. Only differences which
+    do not change the translation are normalized: spaces, Arabic yeh and kaf,
+    ZWNJ. Unlike search.normalize() digits, diacritics and the case of letters
+    are kept, e.g. "2 cups" and "3 cups" are translated differently.
+    '''
+    normalized = ' '.join(text.translate(MEMORY_CHARACTERS).split())
+    return hashlib.sha256(('%s:%s' % (target, normalized)).encode('utf-8')).hexdigest()
+
+
+class TranslationService(object):
+
+    def __init__(self, backend, use_memory=True):
+        self.backend = backend
+        self.use_memory = use_memory
+        # Lookups of the translation memory, see hit_rate
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def recall(self, keys):
+        '''
+        Returns the translations of the keys which are in the memory.
+        '''
+        found = dict(TranslationMemory.objects.filter(
+            key__in=keys).values_list('key', 'translation'))
+        if found:
+            TranslationMemory.objects.filter(key__in=list(found)).update(hits=F('hits') + 1)
+        return found
+
+    def memorize(self, texts, translations, keys, target):
+        TranslationMemory.objects.bulk_create([
+            TranslationMemory(key=keys[text], target=target, source_text=text,
+                              translation=translation)
+            for text, translation in zip(texts, translations)
+        ], ignore_conflicts=True)
+
+    def batches(self, texts):
+        batch = []
+        characters = 0
+        for text in texts:
+            if batch and (len(batch) >= self.backend.max_batch_strings
+                          or characters + len(text) > self.backend.max_batch_characters):
+                yield batch
+                batch = []
+                characters = 0
+            batch.append(text)
+            characters += len(text)
+        if batch:
+            yield batch
+
+    def translate_many(self, texts, target='en', source=None):
+        '''
+        Returns the translations of the texts, in the same order.
+        Blank texts are not sent, and a text which is repeated (or is in the
+        translation memory) is sent once (or not at all).
+        '''
+        texts = [text or '' for text in texts]
+        keys = {}
+        for text in texts:
+            if text.strip() and text not in keys:
+                keys[text] = memory_key(text, target)
+        # key -> translation
+        translations = self.recall(set(keys.values())) if self.use_memory else {}
+        pending = {}
+        for text, key in keys.items():
+            if key not in translations:
+                pending.setdefault(key, text)
+        self.hits += len(set(keys.values())) - len(pending)
+        self.misses += len(pending)
+
+        for batch in self.batches(list(pending.values())):
+            results = self.backend.translate(batch, target, source)
+            for text, translation in zip(batch, results):
+                translations[keys[text]] = translation
+            if self.use_memory:
+                self.memorize(batch, results, keys, target)
+        return [translations[keys[text]] if text in keys else text for text in texts]
+
+    def translate(self, text, target='en', source=None):
+        return self.translate_many([text], target, source)[0]
+
+
+_services = {}
+
+
+def get_translation_service():
+    path = getattr(settings, 'RECIPES_TRANSLATION_BACKEND',
+                   'recipes.translation.GoogleBackend')
+    if path not in _services:
+        _services[path] = TranslationService(import_string(path)())
+    return _services[path]
+
+
+def translate_objects(objects, source_field, target_field, target='en',
+                      batch_size=500):
+    '''
+    Translate source_field of Recipe or CookingStep objects into target_field,
+    batch_size objects at a time, each batch is saved with one bulk_update().
+    The primary keys of a queryset are read first and each batch is loaded by
+    them, as the queryset usually filters on target_field which is updated
+    meanwhile. Returns the number of translated objects, the hit rate of the
+    translation memory is in get_translation_service().hit_rate.
+    '''
+    service = get_translation_service()
+    if isinstance(objects, QuerySet):
+        batches = _queryset_batches(objects, batch_size)
+    else:
+        batches = _batches(objects, batch_size)
+    total = 0
+    for batch in batches:
+        total += _translate_batch(service, batch, source_field, target_field, target)
+    return total
+
+
+def _batches(objects, batch_size):
+    batch = []
+    for obj in objects:
+        batch.append(obj)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _queryset_batches(queryset, batch_size):
+    pks = list(queryset.values_list('pk', flat=True))
+    for start in range(0, len(pks), batch_size):
+        batch = list(queryset.filter(pk__in=pks[start:start + batch_size]))
+        if batch:
+            yield batch
+
+
+def _translate_batch(service, objects, source_field, target_field, target):
+    translations = service.translate_many(
+        [getattr(obj, source_field) for obj in objects], target)
+    for obj, translation in zip(objects, translations):
+        setattr(obj, target_field, translation)
+    model = type(objects[0])
+    with transaction.atomic():
+        model.objects.bulk_update(objects, [target_field])
+        # bulk_update() sends no signals
+        search.reindex(objects)
+        if model is CookingStep:
+            Recipe.update_status({obj.recipe_id for obj in objects}, steps=False)
+    return len(objects)
@@ -6,5 +6,14 @@ from . import views
 router = routers.DefaultRouter()
 router.register('recent_posts', views.RecentPostsViewSet)
 router.register('all_posts', views.AllPostsViewSet)
+router.register('search', views.SearchViewSet, basename='recipe-search')
+router.register('categories', views.CategoryViewSet)
+router.register('export', views.ExportViewSet, basename='recipe-export')
 
-urlpatterns = router.urls
+urlpatterns = router.urls + [
+    url(r'^(?P<pk>[0-9]+)/$',
+        views.RecipeViewSet.as_view({'get': 'retrieve'}), name='recipe-retrieve'),
+    url(r'^categories/(?P<category_pk>[0-9]+)/recipes/$',
+        views.CategoryRecipesViewSet.as_view({'get': 'list'}),
+        name='category-recipes'),
+]
@@ -1,21 +1,15 @@
 import six
-from google.cloud import translate_v2 as translate
 
+from .translation import get_translation_service
 
-def translate_text(target, text):
-    translate_client = translate.Client()
 
+def translate_text(target, text):
+    '''
+    Translate one text, see recipes.translation for translating many of them.
+    '''
     if isinstance(text, six.binary_type):
         text = text.decode("utf-8")
-
-    # Text can also be a sequence of strings, in which case this method
-    # will return a sequence of results for each text.
-    result = translate_client.translate(text, target_language=target)
-    print(u"Text: {}".format(result["input"]))
-    print(u"Translation: {}".format(result["translatedText"]))
-    print(u"Detected source language: {}".format(
-        result["detectedSourceLanguage"]))
-    return result["translatedText"]
+    return get_translation_service().translate(text, target)
 
 
 # text = "بیا تست کنیم"
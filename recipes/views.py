@@ -1,16 +1,234 @@
+from django.http import StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.utils.cache import patch_vary_headers
+from django.utils.decorators import method_decorator
 from rest_framework import viewsets
+from rest_framework.exceptions import ValidationError
+from rest_framework.permissions import IsAdminUser
+from rest_framework.response import Response
 
+from .cache import get_or_build
+from .conditional import recipes_condition
+from .export import FORMATS, export_recipes
 from .models import *
+from .pagination import RecipeCursorPagination
+from .search import search
 from .serializers import *
 
 
-class RecentPostsViewSet (viewsets.ModelViewSet):
+class RecipeFieldsMixin(object):
+    """
+    Sparse fieldsets for the recipe viewsets:
+    - fields: comma separated RecipeSerializer fields, e.g. ?fields=id,title_fa,thumbnail
+    - lang: fa|en, only titles and descriptions of this language are sent
+    Fields which are not sent are not loaded from the database either.
+    """
+
+    def get_requested_fields(self):
+        if not hasattr(self, '_requested_fields'):
+            available = RecipeSerializer.Meta.fields
+            param = self.request.query_params.get('fields')
+            if param:
+                fields = [name.strip() for name in param.split(',') if name.strip()]
+                unknown = [name for name in fields if name not in available]
+                if unknown:
+                    raise ValidationError(
+                        {'fields': 'Unknown fields: %s' % ', '.join(unknown)})
+            else:
+                fields = available
+            self._requested_fields = [name for name in available if name in fields]
+        return self._requested_fields
+
+    def get_requested_lang(self):
+        lang = self.request.query_params.get('lang')
+        if lang is not None and lang not in LANGUAGES:
+            raise ValidationError(
+                {'lang': 'Supported languages: %s' % ', '.join(LANGUAGES)})
+        return lang
+
+    def get_languages(self):
+        lang = self.get_requested_lang()
+        return [lang] if lang else list(LANGUAGES)
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context['fields'] = self.get_requested_fields()
+        context['lang'] = self.get_requested_lang()
+        return context
+
+    def get_queryset(self):
+        fields = self.get_requested_fields()
+        languages = self.get_languages()
+
+        step_fields = ['image', 'image_path']
+        if 'steps' in fields:
+            step_fields += ['description_%s' % lang for lang in languages]
+        queryset = super().get_queryset().with_related(
+            author='author' in fields,
+            categories='categories' in fields,
+            steps='steps' in fields or 'thumbnail' in fields,
+            step_fields=step_fields)
+
+        # published_date is always needed for ordering and pagination
+        columns = ['published_date']
+        if 'author' in fields:
+            columns.append('author')
+        if 'translated' in fields:
+            columns.append('translated')
+        if 'title_fa' in fields or 'title_en' in fields:
+            columns += ['title_%s' % lang for lang in languages]
+        return queryset.only(*columns)
+
+
+class RecentPostsViewSet (RecipeFieldsMixin, viewsets.ModelViewSet):
     serializer_class = RecipeSerializer
-    queryset = Recipe.objects.all().order_by('-published_date')[:9]
+    queryset = Recipe.objects.order_by('-published_date')
     http_method_names = ['get']
 
+    def get_queryset(self):
+        return super().get_queryset()[:9]
+
+    @method_decorator(recipes_condition)
+    def list(self, request, *args, **kwargs):
+        """
+        The serialized recent posts are cached until the next change in recipes
+        (see recipes.cache).
+        """
+        def build():
+            serializer = self.get_serializer(self.get_queryset(), many=True)
+            return list(serializer.data)
 
-class AllPostsViewSet(viewsets.ModelViewSet):
+        name = 'recent_posts:%s:%s' % (','.join(self.get_requested_fields()),
+                                       self.get_requested_lang())
+        return Response(get_or_build(name, build))
+
+
+class AllPostsViewSet(RecipeFieldsMixin, viewsets.ModelViewSet):
     serializer_class = RecipeSerializer
-    queryset = Recipe.objects.all().order_by('-published_date')
+    queryset = Recipe.objects.order_by('-published_date')
+    pagination_class = RecipeCursorPagination
     http_method_names = ['get']
+
+    @method_decorator(recipes_condition)
+    def list(self, request, *args, **kwargs):
+        return super().list(request, *args, **kwargs)
+
+
+class RecipeViewSet(RecipeFieldsMixin, viewsets.ModelViewSet):
+    """
+    Detail of a recipe: /recipe/<id>/
+    """
+    serializer_class = RecipeSerializer
+    queryset = Recipe.objects.all()
+    http_method_names = ['get']
+
+    @method_decorator(recipes_condition)
+    def retrieve(self, request, *args, **kwargs):
+        return super().retrieve(request, *args, **kwargs)
+
+
+class CategoryViewSet(viewsets.ModelViewSet):
+    """
+    Categories with the number of their recipes.
+    The number is a denormalized column (Category.recipe_count), so listing
+    categories does not count the recipes of each one on every request.
+    """
+    serializer_class = CategoryCountSerializer
+    queryset = Category.objects.order_by('-recipe_count', 'title_fa')
+    http_method_names = ['get']
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context['lang'] = self.request.query_params.get('lang')
+        return context
+
+
+class CategoryRecipesViewSet(RecipeFieldsMixin, viewsets.ModelViewSet):
+    """
+    Recipes of a category: /recipe/categories/<id>/recipes/
+    """
+    serializer_class = RecipeSerializer
+    queryset = Recipe.objects.order_by('-published_date')
+    pagination_class = RecipeCursorPagination
+    http_method_names = ['get']
+
+    def get_queryset(self):
+        return super().get_queryset().filter(categories=self.kwargs['category_pk'])
+
+    @method_decorator(recipes_condition)
+    def list(self, request, *args, **kwargs):
+        get_object_or_404(Category, pk=kwargs['category_pk'])
+        return super().list(request, *args, **kwargs)
+
+
+class SearchViewSet(RecipeFieldsMixin, viewsets.GenericViewSet):
+    """
+    Full-text search in titles and cooking steps of recipes: /recipe/search/?q=
+    Results are ranked, the best "limit" (default 20, max 100) are returned.
+    """
+    serializer_class = RecipeSerializer
+    queryset = Recipe.objects.all()
+    default_limit = 20
+    max_limit = 100
+
+    def get_limit(self):
+        try:
+            limit = int(self.request.query_params['limit'])
+        except (KeyError, ValueError):
+            return self.default_limit
+        return max(1, min(limit, self.max_limit))
+
+    @method_decorator(recipes_condition)
+    def list(self, request, *args, **kwargs):
+        ids = search(request.query_params.get('q', ''), self.get_limit())
+        recipes = self.get_queryset().in_bulk(ids)
+        results = [recipes[pk] for pk in ids if pk in recipes]
+        serializer = self.get_serializer(results, many=True)
+        return Response(serializer.data)
+
+
+class ExportViewSet(viewsets.ViewSet):
+    """
+    Export of the whole catalogue for admin users: /recipe/export/?type=jsonl|csv
+    The response is streamed (see recipes.export) and gzipped on the fly if the
+    client accepts it.
+    """
+    permission_classes = [IsAdminUser]
+    content_types = {'jsonl': 'application/x-ndjson', 'csv': 'text/csv'}
+
+    def accepts_gzip(self, request):
+        """
+        True if the Accept-Encoding header allows gzip with a non-zero
+        q-value, either by name or by "*".
+        """
+        qvalues = {}
+        for item in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+            coding, _, params = item.partition(';')
+            coding = coding.strip().lower()
+            if not coding:
+                continue
+            qvalue = 1.0
+            for param in params.split(';'):
+                name, _, value = param.partition('=')
+                if name.strip().lower() == 'q':
+                    try:
+                        qvalue = float(value)
+                    except ValueError:
+                        qvalue = 0.0
+            qvalues[coding] = qvalue
+        return qvalues.get('gzip', qvalues.get('*', 0.0)) > 0
+
+    def list(self, request, *args, **kwargs):
+        export_type = request.query_params.get('type', 'jsonl')
+        if export_type not in FORMATS:
+            raise ValidationError(
+                {'type': 'Supported types: %s' % ', '.join(FORMATS)})
+        compress = self.accepts_gzip(request)
+        response = StreamingHttpResponse(
+            export_recipes(format=export_type, compress=compress),
+            content_type='%s; charset=utf-8' % self.content_types[export_type])
+        response['Content-Disposition'] = 'attachment; filename="recipes.%s"' % export_type
+        patch_vary_headers(response, ['Accept-Encoding'])
+        if compress:
+            response['Content-Encoding'] = 'gzip'
+        return response
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+from w3lib.url import canonicalize_url
+
+
+class FeedArchive(object):
+    '''
+    An on-disk archive of responses, keyed by URL.
+    Bodies are stored gzipped and content-addressed (by their sha256), so a
+    page which did not change between two recordings is stored once:
+        <path>/objects/ab/ab12...ef.gz
+        <path>/urls/<sha1 of the canonical url>.json   (url, status, headers, body)
+    Recording a URL again replaces its entry, the older bodies are kept.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+
+    def url_key(self, url):
+        return hashlib.sha1(canonicalize_url(url).encode('utf-8')).hexdigest()
+
+    def entry_path(self, url):
+        return os.path.join(self.path, 'urls', self.url_key(url) + '.json')
+
+    def object_path(self, digest):
+        return os.path.join(self.path, 'objects', digest[:2], digest + '.gz')
+
+    def get(self, url):
+        '''
+        Returns (entry, body) of the url, or None if it is not archived.
+        '''
+        try:
+            with open(self.entry_path(url), encoding='utf-8') as f:
+                entry = json.load(f)
+            with gzip.open(self.object_path(entry['body']), 'rb') as f:
+                body = f.read()
+        except FileNotFoundError:
+            return None
+        return entry, body
+
+    def put(self, url, status, headers, body):
+        digest = hashlib.sha256(body).hexdigest()
+        path = self.object_path(digest)
+        if not os.path.exists(path):
+            self._write(path, gzip.compress(body))
+        entry = {
+            'url': url,
+            'status': status,
+            'headers': headers,
+            'body': digest,
+            'recorded': time.time(),
+        }
+        self._write(self.entry_path(url), json.dumps(entry).encode('utf-8'))
+        return digest
+
+    def _write(self, path, data):
+        # Write to a temporary file first, an interrupted crawl leaves no
+        # half written files
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+import time
+
+from scrapy.extensions.throttle import AutoThrottle
+
+
+class BackoffAutoThrottle(AutoThrottle):
+    '''
+    AutoThrottle which does not adjust the download delay of a slot while
+    BackoffRetryMiddleware backs off from it (until slot.backoff_until), so a
+    fine response of the slot can not lower the delay before the retry is
+    sent. The delay is adjusted again after that.
+    Enabled instead of AutoThrottle by the crawl profiles (scrapy_app.profiles).
+    '''
+
+    def _response_downloaded(self, response, request, spider):
+        key, slot = self._get_slot(request, spider)
+        if slot is not None and getattr(slot, 'backoff_until', 0) > time.monotonic():
+            return
+        super()._response_downloaded(response, request, spider)
@@ -13,6 +13,7 @@ class RecipeItem(scrapy.Item):
     crowled_date = scrapy.Field()
     author = scrapy.Field()             # FK
     categories = scrapy.Field()         # FK
+    step_count = scrapy.Field()         # number of the CookingStepItems
 
 
 class CategoryItem(scrapy.Item):
@@ -22,6 +23,7 @@ class CategoryItem(scrapy.Item):
 
 class CookingStepItem(scrapy.Item):
     image = scrapy.Field()
+    image_path = scrapy.Field()         # set by StepImagesPipeline
     description_fa = scrapy.Field()
     description_en = scrapy.Field()
     order = scrapy.Field()
@@ -5,7 +5,20 @@
 # See documentation in:
 # https://docs.scrapy.org/en/latest/topics/spider-middleware.html
 
+import logging
+import time
+from collections import defaultdict
+
+from recipes.content import join_descriptions, merge_smilies
 from scrapy import signals
+from scrapy.downloadermiddlewares.retry import RetryMiddleware
+from scrapy.exceptions import IgnoreRequest, NotConfigured
+from scrapy.http import Headers, Request
+from scrapy.responsetypes import responsetypes
+from scrapy_app.archive import FeedArchive
+from scrapy_app.items import CookingStepItem, RecipeItem
+
+logger = logging.getLogger(__name__)
 
 
 class ScrapyAppSpiderMiddleware(object):
@@ -101,3 +114,185 @@ class ScrapyAppDownloaderMiddleware(object):
 
     def spider_opened(self, spider):
         spider.logger.info('Spider opened: %s' % spider.name)
+
+
+class FeedArchiveMiddleware(object):
+    '''
+    Record the responses of the spiders into a FeedArchive, or replay a crawl
+    from it without going to the site:
+        scrapy crawl cookingworkshop -s FEED_ARCHIVE_MODE=record
+        scrapy crawl cookingworkshop -a full=1 -s FEED_ARCHIVE_MODE=replay
+    The archive is in FEED_ARCHIVE_DIR (default: feed_archive). In replay mode
+    the requests which are not archived are ignored.
+    NOTE: The incremental crawl asks for the entries updated since the last
+    crawl, so replay the same kind of crawl which is recorded (e.g. full=1).
+    Enable it in settings:
+        DOWNLOADER_MIDDLEWARES = {
+            'scrapy_app.middlewares.FeedArchiveMiddleware': 950,
+        }
+    '''
+    modes = ('record', 'replay')
+
+    def __init__(self, archive, mode, stats):
+        self.archive = archive
+        self.mode = mode
+        self.stats = stats
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        mode = crawler.settings.get('FEED_ARCHIVE_MODE')
+        if not mode:
+            raise NotConfigured
+        if mode not in cls.modes:
+            raise NotConfigured('FEED_ARCHIVE_MODE must be one of: %s'
+                                % ', '.join(cls.modes))
+        archive = FeedArchive(crawler.settings.get('FEED_ARCHIVE_DIR', 'feed_archive'))
+        return cls(archive, mode, crawler.stats)
+
+    def process_request(self, request, spider):
+        if self.mode != 'replay':
+            return None
+        archived = self.archive.get(request.url)
+        if archived is None:
+            self.stats.inc_value('feed_archive/miss')
+            raise IgnoreRequest('Not archived: %s' % request.url)
+        entry, body = archived
+        self.stats.inc_value('feed_archive/hit')
+        headers = Headers(entry['headers'])
+        respcls = responsetypes.from_args(headers=headers, url=request.url, body=body)
+        return respcls(url=request.url, status=entry['status'], headers=headers,
+                       body=body, request=request)
+
+    def process_response(self, request, response, spider):
+        # Server errors are not archived, a later recording can fix them
+        if self.mode == 'record' and response.status < 500:
+            headers = {
+                key.decode('latin1'): [value.decode('latin1') for value in values]
+                for key, values in response.headers.items()}
+            self.archive.put(request.url, response.status, headers, response.body)
+            self.stats.inc_value('feed_archive/stored')
+        return response
+
+
+class BackoffRetryMiddleware(RetryMiddleware):
+    '''
+    RetryMiddleware which slows down the site before retrying: the download
+    delay of the request's slot is raised to RETRY_BACKOFF_BASE seconds for the
+    first retry, doubled for each next one, at most RETRY_BACKOFF_MAX. The
+    Retry-After header of 429/503 responses is respected (up to the max).
+    The downloader sends the retry (and the other requests of the slot) after
+    that delay. The slot keeps it until slot.backoff_until: BackoffAutoThrottle
+    does not lower it before, AutoThrottle would on the next fine response.
+    Used by the crawl profiles (scrapy_app.profiles).
+    '''
+
+    def __init__(self, settings):
+        super().__init__(settings)
+        self.backoff_base = settings.getfloat('RETRY_BACKOFF_BASE', 1)
+        self.backoff_max = settings.getfloat('RETRY_BACKOFF_MAX', 60)
+        self.crawler = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        middleware = cls(crawler.settings)
+        middleware.crawler = crawler
+        return middleware
+
+    # Scrapy 2.13+ passes no spider to the methods which do not require it,
+    # and warns when it is passed to RetryMiddleware; older versions need it.
+    def process_response(self, request, response, spider=None):
+        args = () if spider is None else (spider,)
+        result = super().process_response(request, response, *args)
+        if isinstance(result, Request):
+            self.slow_down(result, self.get_retry_after(response))
+        return result
+
+    def process_exception(self, request, exception, spider=None):
+        args = () if spider is None else (spider,)
+        result = super().process_exception(request, exception, *args)
+        if isinstance(result, Request):
+            self.slow_down(result)
+        return result
+
+    def get_retry_after(self, response):
+        value = response.headers.get('Retry-After')
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return 0
+
+    def get_delay(self, request, retry_after=0):
+        retries = request.meta.get('retry_times', 1)
+        delay = self.backoff_base * 2 ** (retries - 1)
+        return min(max(delay, retry_after), self.backoff_max)
+
+    def get_slot(self, request):
+        # The downloader keeps the key of the slot in the meta of the request
+        key = request.meta.get('download_slot')
+        engine = getattr(self.crawler, 'engine', None)
+        if key is None or engine is None:
+            return None
+        return engine.downloader.slots.get(key)
+
+    def slow_down(self, request, retry_after=0):
+        slot = self.get_slot(request)
+        if slot is None:
+            return
+        delay = self.get_delay(request, retry_after)
+        slot.backoff_until = max(getattr(slot, 'backoff_until', 0),
+                                 time.monotonic() + delay)
+        if delay > slot.delay:
+            logger.debug('Retrying %s, the delay of %s is %.1f seconds'
+                         % (request.url, request.meta['download_slot'], delay))
+            slot.delay = delay
+
+
+class SmiliesMiddleware(object):
+    '''
+    Merge the cooking steps which have a smiley as their image into their
+    previous step, before the items reach the pipelines (the same as the
+    extract_smilies admin action does for stored recipes). The steps are
+    renumbered and step_count of the recipe is fixed.
+    The output of each response is collected first, as a recipe item comes
+    before its steps. Enabled by the recipe spider:
+        SPIDER_MIDDLEWARES = {
+            'scrapy_app.middlewares.SmiliesMiddleware': 550,
+        }
+    '''
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler.stats)
+
+    def process_spider_output(self, response, result, spider):
+        result = list(result)
+        steps = defaultdict(list)
+        for item in result:
+            if isinstance(item, CookingStepItem):
+                steps[item['recipe']].append(item)
+
+        merged = set()
+        step_counts = {}
+        for recipe_id, items in steps.items():
+            groups = merge_smilies([item.get('image') for item in items])
+            for order, group in enumerate(groups, start=1):
+                step = items[group[0]]
+                smilies = [items[index] for index in group[1:]]
+                if smilies:
+                    for field in ('description_fa', 'description_en'):
+                        step[field] = join_descriptions(
+                            other.get(field) for other in [step] + smilies)
+                    merged.update(id(smiley) for smiley in smilies)
+                step['order'] = order
+            step_counts[recipe_id] = len(groups)
+
+        for item in result:
+            if id(item) in merged:
+                self.stats.inc_value('smilies/merged')
+                continue
+            if isinstance(item, RecipeItem) and item['origin_id'] in step_counts:
+                item['step_count'] = step_counts[item['origin_id']]
+            yield item
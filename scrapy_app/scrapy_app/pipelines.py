@@ -1,8 +1,17 @@
 # -*- coding: utf-8 -*-
+import hashlib
 import logging
+import time
+from collections import defaultdict
 
 from django.core.exceptions import ObjectDoesNotExist
-from recipes.models import Author, Category, CookingStep, Recipe
+from django.db import transaction
+from django.utils.dateparse import parse_datetime
+from recipes import search
+from recipes.models import THUMBNAIL_SIZES, Author, Category, CookingStep, Recipe
+from recipes.signals import deferred_recipe_status
+from scrapy.http import Request
+from scrapy.pipelines.images import ImagesPipeline
 from scrapy_app.items import CategoryItem, CookingStepItem, RecipeItem
 
 logger = logging.getLogger(__name__)
@@ -20,7 +29,104 @@ class RecipesCleanPipeline(object):
         return item
 
 
+class StepImagesPipeline(ImagesPipeline):
+    '''
+    Download the images of cooking steps into IMAGES_STORE and make their
+    thumbnails, the path is stored in CookingStep.image_path. The thumbnails
+    are recipes.models.THUMBNAIL_SIZES, which the API and the admin use, plus
+    the other sizes of IMAGES_THUMBS if it is set.
+    Files are named by the hash of their content, so an image which is used
+    by several steps (or posted again with another url) is stored once:
+        full/<sha1>.jpg
+        thumbs/<size>/<sha1>.jpg
+    Images which are already downloaded for a stored step are not requested.
+    Enable it before RecipesPipeline in settings:
+        ITEM_PIPELINES = {
+            'scrapy_app.pipelines.RecipesCleanPipeline': 300,
+            'scrapy_app.pipelines.StepImagesPipeline': 350,
+            'scrapy_app.pipelines.RecipesPipeline': 400,
+        }
+        IMAGES_STORE = '/path/to/media/recipes/'
+    and serve IMAGES_STORE at RECIPES_IMAGES_URL of the django settings.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.thumbs = dict(self.thumbs, **THUMBNAIL_SIZES)
+
+    def open_spider(self, spider):
+        super().open_spider(spider)
+        # url -> path of the images which are already downloaded
+        self.downloaded = dict(CookingStep.objects.exclude(
+            image_path=None).values_list('image', 'image_path'))
+
+    def get_media_requests(self, item, info):
+        if not isinstance(item, CookingStepItem) or not item.get('image'):
+            return []
+        path = self.downloaded.get(item['image'])
+        if path is not None:
+            item['image_path'] = path
+            return []
+        return [Request(item['image'])]
+
+    def file_path(self, request, response=None, info=None, **kwargs):
+        return 'full/%s.jpg' % self.content_hash(request, response)
+
+    def thumb_path(self, request, thumb_id, response=None, info=None, **kwargs):
+        return 'thumbs/%s/%s.jpg' % (thumb_id, self.content_hash(request, response))
+
+    def content_hash(self, request, response):
+        # Before the download (when checking the store) only the url is known
+        if response is None:
+            return hashlib.sha1(request.url.encode('utf-8')).hexdigest()
+        return hashlib.sha1(response.body).hexdigest()
+
+    def item_completed(self, results, item, info):
+        for ok, result in results:
+            if ok:
+                item['image_path'] = result['path']
+                self.downloaded[item['image']] = result['path']
+        return item
+
+
 class RecipesPipeline():
+    '''
+    Store the scraped items in DB.
+    Authors and categories are loaded into dictionaries when the spider is
+    opened, so resolving them for each recipe needs no query. Hits and misses of
+    these lookups are counted in the crawl stats (recipes_pipeline/...).
+    Recipes which are updated upstream (newer updated_date) are not stored
+    again: their steps are collected until all "step_count" steps are received,
+    then only the changed fields and steps are written in one transaction (see
+    finish_update).
+    '''
+    # Recipe fields which are taken from the feed on every update
+    UPDATED_FIELDS = ('title_fa', 'self_link', 'alternate_link',
+                      'published_date', 'updated_date')
+
+    def __init__(self):
+        self.author_cache = {}
+        self.category_cache = {}
+        self.stats = None
+        # origin_id -> recipe, item data and received steps of updated recipes
+        self.updates = {}
+
+    def open_spider(self, spider):
+        crawler = getattr(spider, 'crawler', None)
+        self.stats = crawler.stats if crawler is not None else None
+        self.author_cache = {
+            author.title_en: author for author in Author.objects.all()}
+        self.category_cache = {
+            category.title_fa: category for category in Category.objects.all()}
+
+    def close_spider(self, spider):
+        # Some steps are not received (e.g. failed requests), store the rest
+        for origin_id in list(self.updates):
+            self.finish_update(origin_id, complete=False)
+
+    def inc_stats(self, key):
+        if self.stats is not None:
+            self.stats.inc_value('recipes_pipeline/%s' % key)
 
     def process_item(self, item, spider):
         # -----------------------------
@@ -41,16 +147,21 @@ class RecipesPipeline():
         # so there is no need to fetch & save data manually :)
         # ------------------------------------------------------
 
-        category = Category.objects.filter(
-            title_fa=item.get('title_fa'))
-        if not category:
-            logger.debug("--- Create new `category` instance: %s" %
-                         item.get('title_fa'))
-            new_category = Category(**item)
-            new_category.save()
+        title = item.get('title_fa')
+        category = self.category_cache.get(title)
+        if category is None:
+            self.inc_stats('category_cache_miss')
+            category = Category.objects.filter(title_fa=title).first()
+        else:
+            self.inc_stats('category_cache_hit')
+        if category is None:
+            logger.debug("--- Create new `category` instance: %s" % title)
+            category = Category(**item)
+            category.save()
         else:
-            logger.debug('--- Duplicate: category(%s)' % item.get('title_fa'))
+            logger.debug('--- Duplicate: category(%s)' % title)
             logger.debug(category)
+        self.category_cache[title] = category
         return item
 
     def process_recipe(self, item, spider):
@@ -60,17 +171,18 @@ class RecipesPipeline():
         # ------------------------------------------------------
 
         recipe = Recipe.objects.filter(
-            origin_id=item.get('origin_id'))
-        if not recipe:
+            origin_id=item.get('origin_id')).first()
+        if recipe is None:
             logger.debug("--- Create new `recipe` instance: %s" %
                          item.get('title_fa'))
             # get required fields from item to store recipe instance
-            data = item
+            data = dict(item)
             data['author'] = self.get_author(item.get('author'))
             # categories is a ManyToManyField and we will save it after we saved the item
             categories = self.get_categories(item.get('categories'))
 
             data.pop('categories', None)
+            data.pop('step_count', None)
             new_recipe = Recipe(**data)
             new_recipe.save()
 
@@ -78,6 +190,8 @@ class RecipesPipeline():
             logger.debug('*** Recipe Category list:')
             logger.debug(categories)
             new_recipe.categories.set(categories)
+        elif self.is_updated(recipe, item):
+            self.start_update(recipe, item)
         else:
             logger.error('--- Duplicate: Recipe(%s)' % item.get('title_fa'))
             logger.error(recipe)
@@ -88,32 +202,382 @@ class RecipesPipeline():
         # we will use django framework to save our data,
         # so there is no need to fetch & save data manually :)
         # ------------------------------------------------------
+        if item.get('recipe') in self.updates:
+            self.add_updated_step(item)
+            return item
         try:
             recipe = Recipe.objects.get(origin_id=item.get('recipe'))
-            data = item
-            data['recipe'] = recipe
-            new_step = CookingStep(**data)
-            new_step.save()
+            step = CookingStep.objects.filter(
+                recipe=recipe, order=item.get('order'))
+            if not step:
+                data = item
+                data['recipe'] = recipe
+                new_step = CookingStep(**data)
+                new_step.save()
+            else:
+                logger.debug('--- Duplicate: step %s of recipe(%s)' %
+                             (item.get('order'), item.get('recipe')))
+                if item.get('image_path'):
+                    # The step is stored before its image is downloaded
+                    step.filter(image=item.get('image'), image_path=None).update(
+                        image_path=item.get('image_path'))
 
         except ObjectDoesNotExist:
             logger.error('--- Recipe -> %s: Not found!!' %
                          item.get('recipe'))
         return item
 
+    def is_updated(self, recipe, item):
+        updated = item.get('updated_date')
+        if isinstance(updated, str):
+            updated = parse_datetime(updated)
+        return updated is not None and (recipe.updated_date is None
+                                        or updated > recipe.updated_date)
+
+    def start_update(self, recipe, item):
+        data = dict(item)
+        step_count = data.pop('step_count', None)
+        self.updates[recipe.origin_id] = {
+            'recipe': recipe, 'data': data, 'step_count': step_count, 'steps': {}}
+        if step_count == 0:
+            self.finish_update(recipe.origin_id)
+
+    def add_updated_step(self, item):
+        origin_id = item.get('recipe')
+        update = self.updates[origin_id]
+        update['steps'][item.get('order')] = dict(item)
+        if len(update['steps']) == update['step_count']:
+            self.finish_update(origin_id)
+
+    def finish_update(self, origin_id, complete=True):
+        '''
+        Apply the changes of an updated recipe and its steps in one transaction.
+        Only the changed rows are written, so unchanged (and moved) steps keep
+        their english description. If not all the steps are received
+        (complete=False), no step is moved or deleted.
+        '''
+        update = self.updates.pop(origin_id)
+        recipe = update['recipe']
+        data = update['data']
+        with transaction.atomic(), deferred_recipe_status():
+            changed = self.update_recipe(recipe, data)
+            untranslated = self.update_steps(recipe, update['steps'], complete)
+            # bulk_update() sends no signals
+            Recipe.update_status([recipe.pk])
+            if 'title_en' in changed or untranslated:
+                recipe.translated = False
+                changed.append('translated')
+            recipe.save(update_fields=changed)
+            recipe.categories.set(
+                self.get_categories(data.get('categories') or []))
+        logger.debug('--- Update: Recipe(%s)' % recipe.title_fa)
+        self.inc_stats('updated_recipes')
+
+    def update_recipe(self, recipe, data):
+        '''
+        Set the changed fields of the recipe, returns their names.
+        '''
+        changed = ['crowled_date']
+        recipe.crowled_date = data.get('crowled_date')
+        for name in self.UPDATED_FIELDS:
+            value = Recipe._meta.get_field(name).to_python(data.get(name))
+            if getattr(recipe, name) != value:
+                setattr(recipe, name, value)
+                changed.append(name)
+        if 'title_fa' in changed and recipe.title_en:
+            # The translation is of the old title
+            recipe.title_en = ''
+            changed.append('title_en')
+        author = self.get_author(data.get('author'))
+        if author is not None and author.pk != recipe.author_id:
+            recipe.author = author
+            changed.append('author')
+        return changed
+
+    def update_steps(self, recipe, steps, complete=True):
+        '''
+        Make the steps of the recipe match the received steps ({order: data}):
+        - a step with the same image and description at the same order is kept,
+        - a step with the same image and description at another order is moved,
+        - otherwise the step at that order is changed (or a new one is created)
+          and its english description is cleared,
+        - the remaining steps are deleted.
+        Returns True if a step needs to be translated again.
+        '''
+        def content(step):
+            return (step.image, step.description_fa)
+
+        def new_content(data):
+            return (data.get('image'), data.get('description_fa'))
+
+        existing = {step.order: step for step in recipe.steps.all()}
+        assigned = {}
+        for order, data in steps.items():
+            step = existing.get(order)
+            if step is not None and content(step) == new_content(data):
+                assigned[order] = step
+        if complete:
+            free = defaultdict(list)
+            for order in sorted(existing):
+                if order not in assigned:
+                    free[content(existing[order])].append(existing[order])
+            for order in sorted(steps):
+                candidates = free.get(new_content(steps[order]))
+                if order not in assigned and candidates:
+                    assigned[order] = candidates.pop(0)
+
+        used = {step.pk for step in assigned.values()}
+        changed = []
+        created = []
+        for order in sorted(steps):
+            if order in assigned:
+                continue
+            data = steps[order]
+            step = existing.get(order)
+            if step is None or step.pk in used:
+                step = CookingStep(recipe=recipe, order=order)
+                created.append(step)
+            else:
+                assigned[order] = step
+                used.add(step.pk)
+                changed.append(step)
+            step.image = data.get('image')
+            step.description_fa = data.get('description_fa')
+            step.description_en = ''
+
+        # Images which are downloaded by StepImagesPipeline
+        downloaded = []
+        for order, step in assigned.items():
+            image_path = steps[order].get('image_path')
+            if image_path and step.image_path != image_path:
+                step.image_path = image_path
+                downloaded.append(step)
+        for step in created:
+            step.image_path = steps[step.order].get('image_path')
+
+        if complete:
+            removed = [step.pk for step in existing.values()
+                       if step.pk not in used]
+            if removed:
+                CookingStep.objects.filter(pk__in=removed).delete()
+        # Move the steps through negative orders, as (recipe, order) is unique
+        moved = [(order, step) for order, step in assigned.items()
+                 if step.order != order]
+        for order, step in moved:
+            step.order = -step.pk
+        CookingStep.objects.bulk_update([step for order, step in moved], ['order'])
+        for order, step in moved:
+            step.order = order
+        updated = {step.pk: step for step in changed + downloaded}
+        updated.update((step.pk, step) for order, step in moved)
+        CookingStep.objects.bulk_update(
+            updated.values(),
+            ['order', 'image', 'image_path', 'description_fa', 'description_en'])
+        # bulk_update() sends no signals
+        for step in changed:
+            search.index_step(step)
+        for step in created:
+            step.save()
+        return bool(changed or created)
+
     def get_author(self, name):
+        author = self.author_cache.get(name)
+        if author is not None:
+            self.inc_stats('author_cache_hit')
+            return author
+        self.inc_stats('author_cache_miss')
         try:
-            return Author.objects.get(title_en=name)
+            author = Author.objects.get(title_en=name)
         except ObjectDoesNotExist:
             logger.error('--- author -> %s: Not found!!' % name)
             return None
+        self.author_cache[name] = author
+        return author
 
     def get_categories(self, categories):
         result = []
         for category in categories:
+            cat_obj = self.category_cache.get(category)
+            if cat_obj is not None:
+                self.inc_stats('category_cache_hit')
+                result.append(cat_obj)
+                continue
+            self.inc_stats('category_cache_miss')
             try:
                 cat_obj = Category.objects.get(title_fa=category)
+                self.category_cache[category] = cat_obj
                 result.append(cat_obj)
             except ObjectDoesNotExist:
                 logger.error('--- category -> %s: Not found!!' % category)
 
         return result
+
+
+class BatchRecipesPipeline(RecipesPipeline):
+    '''
+    Batching mode of RecipesPipeline: items are buffered and stored with
+    bulk_create() in one transaction per batch, instead of one existence check
+    and one save() for each item.
+    A batch is flushed when it has RECIPES_BATCH_SIZE items, when
+    RECIPES_BATCH_INTERVAL seconds are passed since the last flush and when the
+    spider is closed. Enable it instead of RecipesPipeline in settings:
+        ITEM_PIPELINES = {
+            'scrapy_app.pipelines.RecipesCleanPipeline': 300,
+            'scrapy_app.pipelines.BatchRecipesPipeline': 400,
+        }
+    NOTE: bulk_create() sends no signals, so the search index, the recipe
+    count of categories and the status of recipes (Recipe.update_status) are
+    updated by the flush itself.
+    Updated recipes are handled the same way as RecipesPipeline does: their
+    steps are not buffered but collected until the update can be applied.
+    '''
+
+    def __init__(self, batch_size=500, interval=30):
+        super().__init__()
+        self.batch_size = batch_size
+        self.interval = interval
+        self.categories = {}
+        self.recipes = {}
+        self.steps = {}
+        # origin_id -> pk of recipes stored in this crawl
+        self.recipe_ids = {}
+        self.last_flush = time.monotonic()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(batch_size=crawler.settings.getint('RECIPES_BATCH_SIZE', 500),
+                   interval=crawler.settings.getfloat('RECIPES_BATCH_INTERVAL', 30))
+
+    def close_spider(self, spider):
+        self.flush(spider)
+        super().close_spider(spider)
+
+    def process_item(self, item, spider):
+        if isinstance(item, CategoryItem):
+            self.categories[item.get('title_fa')] = dict(item)
+        elif isinstance(item, RecipeItem):
+            self.recipes[item.get('origin_id')] = dict(item)
+        elif isinstance(item, CookingStepItem):
+            if item.get('recipe') in self.updates:
+                self.add_updated_step(item)
+                return item
+            self.steps[(item.get('recipe'), item.get('order'))] = dict(item)
+        else:
+            return item
+
+        buffered = len(self.categories) + len(self.recipes) + len(self.steps)
+        if (buffered >= self.batch_size
+                or time.monotonic() - self.last_flush >= self.interval):
+            self.flush(spider)
+        return item
+
+    def flush(self, spider):
+        if self.categories or self.recipes or self.steps:
+            with transaction.atomic():
+                self.flush_categories()
+                self.flush_recipes()
+                self.flush_steps()
+            logger.debug('--- Batch is stored')
+        self.categories = {}
+        self.recipes = {}
+        self.steps = {}
+        self.last_flush = time.monotonic()
+
+    def flush_categories(self):
+        titles = [title for title in self.categories
+                  if title not in self.category_cache]
+        if not titles:
+            return
+        for category in Category.objects.filter(title_fa__in=titles):
+            self.category_cache[category.title_fa] = category
+        Category.objects.bulk_create([
+            Category(**self.categories[title]) for title in titles
+            if title not in self.category_cache])
+        # bulk_create() does not set the primary keys on every database
+        for category in Category.objects.filter(title_fa__in=titles):
+            self.category_cache[category.title_fa] = category
+
+    def flush_recipes(self):
+        existing = set()
+        for recipe in Recipe.objects.filter(origin_id__in=list(self.recipes)):
+            existing.add(recipe.origin_id)
+            if self.is_updated(recipe, self.recipes[recipe.origin_id]):
+                self.start_update(recipe, self.recipes[recipe.origin_id])
+            else:
+                logger.debug('--- Duplicate: Recipe(%s)' % recipe.origin_id)
+        new = {origin_id: data for origin_id, data in self.recipes.items()
+               if origin_id not in existing}
+        if not new:
+            return
+
+        recipes = []
+        for data in new.values():
+            data = dict(data)
+            author = self.get_author(data.get('author'))
+            if author is None:
+                continue
+            data['author'] = author
+            data.pop('categories', None)
+            data.pop('step_count', None)
+            recipes.append(Recipe(**data))
+        Recipe.objects.bulk_create(recipes)
+
+        # bulk_create() does not set the primary keys on every database
+        recipes = list(Recipe.objects.filter(origin_id__in=list(new)).only(
+            'origin_id', 'title_fa', 'title_en'))
+        RecipeCategory = Recipe.categories.through
+        links = []
+        for recipe in recipes:
+            self.recipe_ids[recipe.origin_id] = recipe.pk
+            for category in self.get_categories(
+                    new[recipe.origin_id].get('categories') or []):
+                links.append(RecipeCategory(
+                    recipe_id=recipe.pk, category_id=category.pk))
+        RecipeCategory.objects.bulk_create(links)
+        Category.update_recipe_count({link.category_id for link in links})
+        search.index_new(recipes=recipes)
+
+    def flush_steps(self):
+        # Steps of the recipes which are updated in this batch
+        for key in [key for key in self.steps if key[0] in self.updates]:
+            self.add_updated_step(self.steps.pop(key))
+
+        # Resolve recipes from this crawl and query only the other ones
+        missing = {origin_id for origin_id, order in self.steps
+                   if origin_id not in self.recipe_ids}
+        if missing:
+            self.recipe_ids.update(Recipe.objects.filter(
+                origin_id__in=missing).values_list('origin_id', 'pk'))
+
+        steps = {}
+        for (origin_id, order), data in self.steps.items():
+            if origin_id not in self.recipe_ids:
+                logger.error('--- Recipe -> %s: Not found!!' % origin_id)
+                continue
+            data = dict(data)
+            data['recipe_id'] = self.recipe_ids[origin_id]
+            data.pop('recipe')
+            steps[(data['recipe_id'], order)] = data
+        if not steps:
+            return
+
+        recipe_ids = {recipe_id for recipe_id, order in steps}
+        existing = set(CookingStep.objects.filter(
+            recipe_id__in=recipe_ids).values_list('recipe_id', 'order'))
+        for key in existing & set(steps):
+            logger.debug('--- Duplicate: step %s of recipe(%s)' % (key[1], key[0]))
+            data = steps.pop(key)
+            if data.get('image_path'):
+                # The step is stored before its image is downloaded
+                CookingStep.objects.filter(
+                    recipe_id=key[0], order=key[1], image=data.get('image'),
+                    image_path=None).update(image_path=data.get('image_path'))
+        CookingStep.objects.bulk_create(
+            [CookingStep(**data) for data in steps.values()])
+
+        new = [step for step in CookingStep.objects.filter(
+            recipe_id__in={recipe_id for recipe_id, order in steps}).only(
+            'recipe', 'order', 'description_fa', 'description_en')
+            if (step.recipe_id, step.order) in steps]
+        search.index_new(steps=new)
+        Recipe.update_status({recipe_id for recipe_id, order in steps})
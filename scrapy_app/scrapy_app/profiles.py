@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+'''
+Crawl profiles: tuned Scrapy settings for the recipe spider, chosen by
+    scrapy crawl cookingworkshop -s CRAWL_PROFILE=fast
+- polite (default): few parallel requests and long delays, for the
+  regular incremental crawls.
+- fast: for full re-crawls; AutoThrottle still lowers the concurrency when
+  the site gets slow.
+In both of them AutoThrottle adapts the download delay to the measured
+latency, 5xx/429 responses are retried with exponential backoff
+(BackoffRetryMiddleware and BackoffAutoThrottle), DNS lookups are cached
+and HTTP connections are kept alive and reused (up to
+CONCURRENT_REQUESTS_PER_DOMAIN per host).
+Settings given on the command line (-s) win over the profile.
+'''
+
+COMMON = {
+    'AUTOTHROTTLE_ENABLED': True,
+    'RETRY_ENABLED': True,
+    'RETRY_HTTP_CODES': [500, 502, 503, 504, 522, 524, 408, 429],
+    'DNSCACHE_ENABLED': True,
+    'DNSCACHE_SIZE': 1000,
+    'COOKIES_ENABLED': False,
+    'DOWNLOAD_TIMEOUT': 30,
+}
+
+PROFILES = {
+    'polite': {
+        'CONCURRENT_REQUESTS': 4,
+        'CONCURRENT_REQUESTS_PER_DOMAIN': 2,
+        'DOWNLOAD_DELAY': 1,
+        'AUTOTHROTTLE_START_DELAY': 2,
+        'AUTOTHROTTLE_MAX_DELAY': 60,
+        'AUTOTHROTTLE_TARGET_CONCURRENCY': 1.0,
+        'RETRY_TIMES': 5,
+        'RETRY_BACKOFF_BASE': 2,
+        'RETRY_BACKOFF_MAX': 120,
+    },
+    'fast': {
+        'CONCURRENT_REQUESTS': 32,
+        'CONCURRENT_REQUESTS_PER_DOMAIN': 16,
+        'DOWNLOAD_DELAY': 0,
+        'AUTOTHROTTLE_START_DELAY': 0.25,
+        'AUTOTHROTTLE_MAX_DELAY': 10,
+        'AUTOTHROTTLE_TARGET_CONCURRENCY': 8.0,
+        'RETRY_TIMES': 3,
+        'RETRY_BACKOFF_BASE': 0.5,
+        'RETRY_BACKOFF_MAX': 30,
+        'REACTOR_THREADPOOL_MAXSIZE': 20,
+    },
+}
+
+DEFAULT_PROFILE = 'polite'
+
+
+def apply_profile(settings, priority='spider'):
+    name = settings.get('CRAWL_PROFILE') or DEFAULT_PROFILE
+    if name not in PROFILES:
+        raise ValueError('CRAWL_PROFILE must be one of: %s' % ', '.join(PROFILES))
+    settings.setdict(COMMON, priority=priority)
+    settings.setdict(PROFILES[name], priority=priority)
+    # Keep the middlewares of the project settings
+    middlewares = dict(settings.getdict('DOWNLOADER_MIDDLEWARES'))
+    middlewares.update({
+        'scrapy.downloadermiddlewares.retry.RetryMiddleware': None,
+        'scrapy_app.middlewares.BackoffRetryMiddleware': 550,
+    })
+    settings.set('DOWNLOADER_MIDDLEWARES', middlewares, priority=priority)
+    extensions = dict(settings.getdict('EXTENSIONS'))
+    extensions.update({
+        'scrapy.extensions.throttle.AutoThrottle': None,
+        'scrapy_app.extensions.BackoffAutoThrottle': 0,
+    })
+    settings.set('EXTENSIONS', extensions, priority=priority)
@@ -3,37 +3,165 @@ import json
 import logging
 import re
 from datetime import datetime
+from urllib.parse import urlencode
 
 import scrapy
-from scrapy.selector import Selector
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from recipes.content import extract_steps
+from recipes.models import CrawlState, Recipe
+from scrapy import signals
 from scrapy_app.items import CookingStepItem, RecipeItem
+from scrapy_app.profiles import apply_profile
 
 logger = logging.getLogger(__name__)
 
 
 class CookingworkshopSpider(scrapy.Spider):
+    '''
+    Crawls the recipes of the blog feed.
+    The crawl is incremental: the feed is asked for posts updated since the
+    watermark of the last finished crawl (updated-min), newest first, and only
+    the entries which are new or updated since they were stored are requested.
+    Paginating stops at the first unchanged entry, since the rest are older.
+    Run "scrapy crawl cookingworkshop -a full=1" to crawl everything, and
+    "-s CRAWL_PROFILE=fast" to crawl with the fast profile (scrapy_app.profiles).
+    The summary feed has no content, so each entry is requested separately
+    (1 + N requests per page). With "-a feed=default" the full feed is crawled
+    instead, and the items are built from its entries in 1 request per page.
+    Smiley images are merged into their previous steps by SmiliesMiddleware.
+    The watermark is not moved when an entry fails: its request, its callback
+    or the pipelines (errors and dropped items), so the next run retries it.
+    '''
     name = 'cookingworkshop'
-    url = 'http://www.cheftayebeh.ir/feeds/posts/summary?start-index=1&max-results=150&alt=json'
+    feeds = ('summary', 'default')
+    feed_url = 'http://www.cheftayebeh.ir/feeds/posts/%s'
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        for signal in (signals.item_error, signals.item_dropped, signals.spider_error):
+            crawler.signals.connect(spider.item_failed, signal=signal)
+        return spider
+
+    @classmethod
+    def update_settings(cls, settings):
+        super().update_settings(settings)
+        apply_profile(settings)
+        middlewares = dict(settings.getdict('SPIDER_MIDDLEWARES'))
+        middlewares['scrapy_app.middlewares.SmiliesMiddleware'] = 550
+        settings.set('SPIDER_MIDDLEWARES', middlewares, priority='spider')
+
+    def __init__(self, full=False, feed='summary', *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if feed not in self.feeds:
+            raise ValueError('feed must be one of: %s' % ', '.join(self.feeds))
+        self.feed = feed
+        self.full = full not in (False, '0', 'false', 'False', '')
+        self.watermark = None
+        self.newest_update = None
+        self.failed_entries = 0
+        self.known = {}
 
     def start_requests(self):
-        yield scrapy.Request(self.url, self.parse)
+        if not self.full:
+            self.load_state()
+        yield scrapy.Request(self.get_feed_url(), self.parse)
+
+    def load_state(self):
+        state = CrawlState.objects.filter(spider=self.name).first()
+        if state is not None:
+            self.watermark = state.watermark
+
+    def load_known(self, entries):
+        '''
+        Stored updated_date of the recipes of a feed page, by origin_id.
+        '''
+        origin_ids = [self.get_id(entry['id']['$t']) for entry in entries]
+        self.known = dict(Recipe.objects.filter(
+            origin_id__in=origin_ids).values_list('origin_id', 'updated_date'))
+
+    def get_feed_url(self):
+        params = {
+            'start-index': 1,
+            'max-results': 150,
+            'alt': 'json',
+        }
+        if self.watermark is not None:
+            params['orderby'] = 'updated'
+            params['updated-min'] = self.watermark.isoformat()
+        return self.feed_url % self.feed + '?' + urlencode(params)
+
+    def closed(self, reason):
+        # Keep the watermark of unfinished crawls, the next run retries them
+        if reason != 'finished' or self.newest_update is None:
+            return
+        if self.failed_entries:
+            logger.error("-----%d entries or items are failed, watermark is not "
+                         "updated" % self.failed_entries)
+            return
+        if self.watermark is not None and self.watermark >= self.newest_update:
+            return
+        CrawlState.objects.update_or_create(
+            spider=self.name,
+            defaults={'watermark': self.newest_update,
+                      'finished_date': timezone.now()})
+
+    def track_update(self, entry):
+        updated = parse_datetime(entry['updated']['$t'])
+        if updated is not None and (self.newest_update is None
+                                    or updated > self.newest_update):
+            self.newest_update = updated
+        return updated
+
+    def is_changed(self, entry, updated):
+        '''
+        Check if the feed entry is new or updated since it was stored.
+        '''
+        origin_id = self.get_id(entry['id']['$t'])
+        if origin_id not in self.known:
+            return True
+        stored = self.known[origin_id]
+        return stored is None or updated is None or updated > stored
 
     def parse(self, response):
         data = self.get_data(response)
         if data is None:
             return
-        entries = data['feed']['entry']
-        i = 0
+        entries = data['feed'].get('entry', [])
+        if not self.full:
+            self.load_known(entries)
+        reached_known = False
         for entry in entries:
-            # i += 1    # just uncomment this line for debug
-            if i < 2:
-                recipe_page = self.get_link(entry['link'], 'self')
-                yield scrapy.Request(recipe_page, self.parse_recipe_page)
+            updated = self.track_update(entry)
+            if not self.full and not self.is_changed(entry, updated):
+                self.crawler.stats.inc_value('incremental/unchanged_entries')
+                if self.watermark is not None:
+                    # The feed is ordered by update, the rest are older
+                    reached_known = True
+                    break
+                continue
+            if self.feed == 'default':
+                for item in self.parse_entry(entry):
+                    yield item
+                continue
+            recipe_page = self.get_link(entry['link'], 'self')
+            yield scrapy.Request(recipe_page, self.parse_recipe_page,
+                                 errback=self.entry_failed)
 
         next_url = self.get_link(data['feed']['link'], 'next')
-        if next_url:
+        if next_url and not reached_known:
             yield scrapy.Request(next_url, self.parse)
 
+    def entry_failed(self, failure):
+        self.failed_entries += 1
+        logger.error("-----Can not retrive entry: %s" % failure.request.url)
+
+    def item_failed(self, spider, **kwargs):
+        # item_error, item_dropped and spider_error signals
+        if spider is self:
+            self.failed_entries += 1
+
     def get_data(self, response):
         if response.status != 200:
             logger.error("-----Can not retrive page!")
@@ -56,11 +184,45 @@ class CookingworkshopSpider(scrapy.Spider):
     def parse_recipe_page(self, response):
         response.selector.remove_namespaces()
         recipe_item = self.parse_recipe_item(response)
+        steps = list(self.parse_steps(response, recipe_item['origin_id']))
+        # The pipeline applies an update when all steps are received
+        recipe_item['step_count'] = len(steps)
         yield recipe_item
 
-        for step in self.parse_steps(response, recipe_item['origin_id']):
+        for step in steps:
             yield step
 
+    def parse_entry(self, entry):
+        '''
+        Items of an entry of the full feed (JSON), the same as parse_recipe_page
+        yields for the entry's own page.
+        '''
+        recipe_item = self.parse_entry_item(entry)
+        content_txt = entry.get('content', {}).get('$t', '')
+        steps = list(self.parse_content(content_txt, recipe_item['origin_id']))
+        recipe_item['step_count'] = len(steps)
+        yield recipe_item
+
+        for step in steps:
+            yield step
+
+    def parse_entry_item(self, entry):
+        recipe_item = RecipeItem()
+        recipe_item['origin_id'] = self.get_id(entry['id']['$t'])
+        recipe_item['published_date'] = entry['published']['$t']
+        recipe_item['updated_date'] = entry['updated']['$t']
+        recipe_item['crowled_date'] = datetime.now()
+        recipe_item['title_fa'] = entry['title']['$t']
+        recipe_item['title_en'] = ''
+        recipe_item['self_link'] = self.get_link(entry['link'], 'self')
+        recipe_item['alternate_link'] = self.get_link(entry['link'], 'alternate')
+        recipe_item['author'] = entry['author'][0]['name']['$t']
+        recipe_item['categories'] = [
+            category['term'] for category in entry.get('category', [])]
+        logger.debug(recipe_item['categories'])
+
+        return recipe_item
+
     def parse_recipe_item(self, response):
         recipe_item = RecipeItem()
         recipe_item['origin_id'] = self.get_id(response.xpath(
@@ -84,31 +246,13 @@ class CookingworkshopSpider(scrapy.Spider):
         return recipe_item
 
     def parse_steps(self, response, recipe_id):
-        step_item = CookingStepItem()
         content_txt = response.xpath('//content/text()').get()
-        images = self.parse_images(content_txt)
-        descriptions = self.parse_descriptions(content_txt)
-        for i in range(len(images)):
-            yield self.fill_step_item(recipe_id, i+1, images[i], descriptions[i])
-
-    def parse_images(self, content_txt):
-        content = Selector(text=content_txt)
-        return content.xpath('//img/@src').getall()
-
-    def parse_descriptions(self, content_txt):
-        sections = content_txt.split('<img')
-        sections.pop(0)  # delete tags before first image tag
-        for i in range(len(sections)):
-            # modify image tag to convert it to a html tag again
-            sections[i] = '<img' + sections[i]
-            sections[i] = self.cleanhtml(sections[i])
-        return sections
-
-    def cleanhtml(self, raw_html):
-        # html tag + enteties like &nsbm
-        cleanr = re.compile('<.*?>|&([a-z0-9]+|#[0-9]{1,6}|#x[0-9a-f]{1,6});')
-        cleantext = re.sub(cleanr, '', raw_html)
-        return cleantext
+        return self.parse_content(content_txt, recipe_id)
+
+    def parse_content(self, content_txt, recipe_id):
+        steps = extract_steps(content_txt)
+        for order, (image, description) in enumerate(steps, start=1):
+            yield self.fill_step_item(recipe_id, order, image, description)
 
     def fill_step_item(self, recipe_id, order, image, description):
         step_item = CookingStepItem()
@@ -0,0 +1,462 @@
+# -*- coding: utf-8 -*-
+'''
+Tests of the spider, its middlewares and pipelines. They store items by the
+Django models, run them from the root of the repository with the scrapy
+project on the path:
+    PYTHONPATH=scrapy_app python manage.py test scrapy_app.tests
+'''
+import json
+import tempfile
+from types import SimpleNamespace
+
+from django.db import connection
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils.dateparse import parse_datetime
+from recipes import search
+from recipes.models import (THUMBNAIL_SIZES, Author, Category, CookingStep, CrawlState,
+                            Recipe)
+from recipes.tests import load_testdata
+from scrapy import signals
+from scrapy.exceptions import IgnoreRequest
+from scrapy.extensions.throttle import AutoThrottle
+from scrapy.http import Request, Response, TextResponse
+from scrapy.settings import Settings
+from scrapy.utils.test import get_crawler
+from scrapy_app.extensions import BackoffAutoThrottle
+from scrapy_app.items import CategoryItem, CookingStepItem, RecipeItem
+from scrapy_app.middlewares import BackoffRetryMiddleware, FeedArchiveMiddleware
+from scrapy_app.pipelines import BatchRecipesPipeline, RecipesPipeline, StepImagesPipeline
+from scrapy_app.profiles import PROFILES, apply_profile
+from scrapy_app.spiders.cookingworkshop import CookingworkshopSpider
+
+
+def create_spider(**kwargs):
+    crawler = get_crawler(CookingworkshopSpider)
+    return CookingworkshopSpider.from_crawler(crawler, **kwargs)
+
+
+def feed_response(entries, url='http://www.cheftayebeh.ir/feeds/posts/summary'):
+    '''
+    A page of the JSON feed, entries are (post id, updated date).
+    '''
+    data = {'feed': {'link': [], 'entry': [{
+        'id': {'$t': 'tag:blogger.com,1999:blog-1.post-%s' % post_id},
+        'updated': {'$t': updated},
+        'link': [{'rel': 'self', 'href': 'http://www.blogger.com/feeds/1/posts/default/%s'
+                  % post_id}],
+    } for post_id, updated in entries]}}
+    return TextResponse(url, body=json.dumps(data).encode('utf-8'), encoding='utf-8',
+                        request=Request(url))
+
+
+def recipe_items(origin_id, steps, updated='2020-01-01T00:00:00+03:30'):
+    '''
+    Items of a recipe as the spider yields them, steps are (image, description).
+    '''
+    items = [
+        CategoryItem(title_fa='دسر', title_en=''),
+        RecipeItem(origin_id=origin_id, title_fa='غذا %s' % origin_id, title_en='',
+                   self_link=None, alternate_link=None,
+                   published_date='2020-01-01T00:00:00+03:30',
+                   updated_date=updated, crowled_date='2020-01-02T00:00:00+03:30',
+                   author='Tayebeh', categories=['دسر'], step_count=len(steps)),
+    ]
+    for order, (image, description) in enumerate(steps, start=1):
+        items.append(CookingStepItem(image=image, description_fa=description,
+                                     description_en='', order=order,
+                                     recipe=origin_id))
+    return items
+
+
+class StepImagesPipelineTest(SimpleTestCase):
+
+    def test_thumbs(self):
+        # the sizes of the API are always made, other sizes are kept
+        with tempfile.TemporaryDirectory() as directory:
+            crawler = get_crawler(CookingworkshopSpider, {
+                'IMAGES_STORE': directory,
+                'IMAGES_THUMBS': {'medium': (300, 300), 'large': (800, 800)}})
+            pipeline = StepImagesPipeline.from_crawler(crawler)
+        self.assertEqual(pipeline.thumbs, dict(THUMBNAIL_SIZES, large=(800, 800)))
+
+
+class BatchRecipesPipelineTest(TestCase):
+
+    def setUp(self):
+        Author.objects.create(title_fa='طیبه', title_en='Tayebeh')
+        self.spider = create_spider()
+
+    def process(self, pipeline, items):
+        for item in items:
+            pipeline.process_item(item, self.spider)
+
+    def test_buffered_until_closed(self):
+        pipeline = BatchRecipesPipeline(batch_size=10, interval=3600)
+        pipeline.open_spider(self.spider)
+        items = (recipe_items('1', [('a.jpg', 'آرد'), ('b.jpg', 'شکر')])
+                 + recipe_items('2', [('c.jpg', 'شیر'), ('d.jpg', '-')]))
+        with self.assertNumQueries(0):
+            self.process(pipeline, items)
+        self.assertFalse(Recipe.objects.exists())
+
+        pipeline.close_spider(self.spider)
+        self.assertEqual(list(CookingStep.objects.order_by('recipe__origin_id', 'order')
+                              .values_list('recipe__origin_id', 'order', 'image')),
+                         [('1', 1, 'a.jpg'), ('1', 2, 'b.jpg'),
+                          ('2', 1, 'c.jpg'), ('2', 2, 'd.jpg')])
+        # the denormalized data which bulk_create() does not update
+        self.assertEqual(Category.objects.get().recipe_count, 2)
+        self.assertEqual(dict(Recipe.objects.values_list(
+            'origin_id', 'untranslated_step_count')), {'1': 2, '2': 1})
+        self.assertTrue(CookingStep.objects.get(image='d.jpg').is_empty)
+        recipe = Recipe.objects.get(origin_id='2')
+        self.assertEqual(search.search('شیر'), [recipe.pk])
+
+    def test_flush_by_batch_size(self):
+        pipeline = BatchRecipesPipeline(batch_size=4, interval=3600)
+        pipeline.open_spider(self.spider)
+        # a category, a recipe and two steps fill the batch
+        self.process(pipeline, recipe_items('1', [('a.jpg', 'آرد'), ('b.jpg', 'شکر')]))
+        self.assertEqual(CookingStep.objects.filter(recipe__origin_id='1').count(), 2)
+        # steps of a recipe which is stored by an earlier batch
+        self.process(pipeline, [CookingStepItem(image='c.jpg', description_fa='شیر',
+                                                description_en='', order=3, recipe='1')])
+        pipeline.close_spider(self.spider)
+        self.assertEqual(Recipe.objects.get().untranslated_step_count, 3)
+
+
+class RecipesPipelineCacheTest(TestCase):
+    '''
+    Authors and categories are loaded once when the spider is opened.
+    '''
+
+    def setUp(self):
+        Author.objects.create(title_fa='طیبه', title_en='Tayebeh')
+        Category.objects.create(title_fa='دسر')
+        self.spider = create_spider()
+        self.pipeline = RecipesPipeline()
+        self.pipeline.open_spider(self.spider)
+
+    def stats(self, name):
+        return self.spider.crawler.stats.get_value('recipes_pipeline/%s' % name)
+
+    def test_lookups(self):
+        with CaptureQueriesContext(connection) as context:
+            for origin_id in ('1', '2', '3'):
+                for item in recipe_items(origin_id, [('a.jpg', 'آرد')]):
+                    self.pipeline.process_item(item, self.spider)
+        # no lookup of an author or a category by its name
+        self.assertFalse([query for query in context.captured_queries
+                          if '"recipes_author"."title_en" =' in query['sql']
+                          or '"recipes_category"."title_fa" =' in query['sql']])
+        self.assertEqual(self.stats('author_cache_hit'), 3)
+        self.assertEqual(self.stats('category_cache_hit'), 6)
+        self.assertIsNone(self.stats('author_cache_miss'))
+        self.assertEqual(list(Recipe.objects.values_list('author__title_en', flat=True)),
+                         ['Tayebeh'] * 3)
+
+    def test_miss(self):
+        # created after the spider is opened, found by a query then cached
+        Author.objects.create(title_en='Guest')
+        for origin_id in ('1', '2'):
+            items = recipe_items(origin_id, [])
+            items[1]['author'] = 'Guest'
+            for item in items:
+                self.pipeline.process_item(item, self.spider)
+        self.assertEqual((self.stats('author_cache_miss'), self.stats('author_cache_hit')),
+                         (1, 1))
+        self.assertIsNone(self.pipeline.get_author('Nobody'))
+
+
+class IncrementalCrawlTest(TestCase):
+
+    def setUp(self):
+        author = Author.objects.create(title_en='Tayebeh')
+        for origin_id in ('1', '9'):
+            Recipe.objects.create(origin_id=origin_id, author=author, updated_date=parse_datetime(
+                '2020-01-01T00:00:00+03:30'))
+        self.entries = [('2', '2020-02-01T00:00:00.000+03:30'),
+                        ('1', '2020-01-01T00:00:00.000+03:30')]
+
+    def crawl(self):
+        spider = create_spider()
+        start = list(spider.start_requests())
+        requests = list(spider.parse(feed_response(self.entries, start[0].url)))
+        return spider, start, requests
+
+    def test_changed_entries(self):
+        spider, start, requests = self.crawl()
+        self.assertNotIn('updated-min', start[0].url)
+        # only the stored recipes of the page are loaded
+        self.assertEqual(set(spider.known), {'1'})
+        self.assertEqual([request.url for request in requests],
+                         ['http://www.blogger.com/feeds/1/posts/default/2'])
+        spider.closed('finished')
+        self.assertEqual(CrawlState.objects.get(spider=spider.name).watermark,
+                         parse_datetime('2020-02-01T00:00:00+03:30'))
+
+        # the next crawl asks for the entries updated since the watermark
+        spider, start, requests = self.crawl()
+        self.assertIn('updated-min=2020-01-31T20%3A30%3A00', start[0].url)
+
+    def test_failed_entry(self):
+        spider, start, requests = self.crawl()
+        spider.entry_failed(SimpleNamespace(request=requests[0]))
+        spider.closed('finished')
+        self.assertFalse(CrawlState.objects.exists())
+
+    def test_failed_items(self):
+        for signal in (signals.item_error, signals.item_dropped):
+            spider, start, requests = self.crawl()
+            spider.crawler.signals.send_catch_log(
+                signal, item=RecipeItem(origin_id='2'), response=None, spider=spider,
+                failure=None, exception=None)
+            spider.closed('finished')
+            self.assertFalse(CrawlState.objects.exists())
+
+
+class StepUpsertTest(TestCase):
+    '''
+    An updated recipe (newer updated_date) changes only the steps which are
+    changed: moved steps keep their translation, through the unique
+    (recipe, order) constraint.
+    '''
+
+    def setUp(self):
+        Author.objects.create(title_en='Tayebeh')
+        self.spider = create_spider()
+
+    def crawl(self, pipeline_class, items):
+        pipeline = pipeline_class()
+        pipeline.open_spider(self.spider)
+        for item in items:
+            pipeline.process_item(item, self.spider)
+        pipeline.close_spider(self.spider)
+
+    def check_update(self, pipeline_class):
+        self.crawl(pipeline_class, recipe_items(
+            '1', [('a.jpg', 'آرد'), ('b.jpg', 'شکر'), ('c.jpg', 'شیر'), ('d.jpg', 'تخم مرغ')]))
+        CookingStep.objects.update(description_en='Translated')
+        Recipe.objects.update(title_en='Cake', translated=True)
+        pks = dict(CookingStep.objects.values_list('image', 'pk'))
+
+        # a and b are swapped, c is changed and d is removed
+        self.crawl(pipeline_class, recipe_items(
+            '1', [('b.jpg', 'شکر'), ('a.jpg', 'آرد'), ('c.jpg', 'شیر گرم')],
+            updated='2020-02-01T00:00:00+03:30'))
+        self.assertEqual(list(CookingStep.objects.order_by('order').values_list(
+            'pk', 'order', 'description_fa', 'description_en')), [
+            (pks['b.jpg'], 1, 'شکر', 'Translated'),
+            (pks['a.jpg'], 2, 'آرد', 'Translated'),
+            (pks['c.jpg'], 3, 'شیر گرم', ''),
+        ])
+        recipe = Recipe.objects.get()
+        self.assertEqual((recipe.title_en, recipe.translated, recipe.untranslated_step_count),
+                         ('Cake', False, 1))
+        self.assertEqual(search.search('گرم'), [recipe.pk])
+
+    def test_recipes_pipeline(self):
+        self.check_update(RecipesPipeline)
+
+    def test_batch_pipeline(self):
+        self.check_update(BatchRecipesPipeline)
+
+
+class FullFeedTest(TestCase):
+    '''
+    With feed=default the items are built from the entries of the feed page,
+    with no request for each entry (testdata of recipes, see ExtractStepsTest).
+    '''
+
+    def test_items(self):
+        spider = create_spider(feed='default', full='1')
+        start = list(spider.start_requests())
+        self.assertIn('/feeds/posts/default?', start[0].url)
+
+        data = load_testdata('feed.json')
+        response = TextResponse(start[0].url, body=json.dumps(data).encode('utf-8'),
+                                encoding='utf-8', request=start[0])
+        output = list(spider.parse(response))
+        self.assertFalse([item for item in output if isinstance(item, Request)])
+
+        golden = load_testdata('feed.steps.json')
+        recipes = [item for item in output if isinstance(item, RecipeItem)]
+        self.assertEqual([item['origin_id'] for item in recipes], list(golden))
+        for entry, recipe in zip(data['feed']['entry'], recipes):
+            origin_id = recipe['origin_id']
+            self.assertEqual(recipe['title_fa'], entry['title']['$t'])
+            self.assertEqual(recipe['updated_date'], entry['updated']['$t'])
+            self.assertEqual(recipe['author'], 'Tayebeh')
+            self.assertEqual(recipe['categories'],
+                             [category['term'] for category in entry['category']])
+            self.assertEqual(recipe['alternate_link'],
+                             'http://www.cheftayebeh.ir/2019/11/post-%s.html' % origin_id)
+            steps = [item for item in output if isinstance(item, CookingStepItem)
+                     and item['recipe'] == origin_id]
+            self.assertEqual(recipe['step_count'], len(golden[origin_id]))
+            self.assertEqual([[step['image'], step['description_fa']] for step in steps],
+                             golden[origin_id])
+            self.assertEqual([step['order'] for step in steps],
+                             list(range(1, len(steps) + 1)))
+
+
+class FeedArchiveMiddlewareTest(SimpleTestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def middleware(self, mode):
+        crawler = get_crawler(CookingworkshopSpider, {
+            'FEED_ARCHIVE_MODE': mode, 'FEED_ARCHIVE_DIR': self.directory})
+        return FeedArchiveMiddleware.from_crawler(crawler), crawler.stats
+
+    def parse(self, response):
+        spider = create_spider(feed='default', full='1')
+        items = [dict(item) for item in spider.parse(response)]
+        for item in items:
+            # the time of the crawl
+            item.pop('crowled_date', None)
+        return items
+
+    def test_replay(self):
+        request = Request('http://www.cheftayebeh.ir/feeds/posts/default?alt=json')
+        response = TextResponse(
+            request.url, status=200, request=request,
+            headers={'Content-Type': 'application/json; charset=UTF-8'},
+            body=json.dumps(load_testdata('feed.json')).encode('utf-8'))
+        spider = create_spider()
+        recorder, stats = self.middleware('record')
+        self.assertIs(recorder.process_response(request, response, spider), response)
+        self.assertIsNone(recorder.process_request(request, spider))
+        # server errors are not archived
+        error = Request('http://www.cheftayebeh.ir/feeds/posts/default?start-index=151')
+        recorder.process_response(error, TextResponse(error.url, status=503), spider)
+        self.assertEqual(stats.get_value('feed_archive/stored'), 1)
+
+        player, stats = self.middleware('replay')
+        replayed = player.process_request(request.replace(), spider)
+        self.assertEqual((replayed.status, replayed.body), (200, response.body))
+        self.assertEqual(self.parse(replayed), self.parse(response))
+        with self.assertRaises(IgnoreRequest):
+            player.process_request(error, spider)
+        self.assertEqual((stats.get_value('feed_archive/hit'),
+                          stats.get_value('feed_archive/miss')), (1, 1))
+
+
+class BackoffRetryMiddlewareTest(SimpleTestCase):
+
+    def setUp(self):
+        settings = {key: value for key, value in PROFILES['polite'].items()
+                    if key.startswith(('RETRY_', 'AUTOTHROTTLE_', 'DOWNLOAD_'))}
+        settings.update(AUTOTHROTTLE_ENABLED=True, RETRY_HTTP_CODES=[429, 503])
+        self.crawler = get_crawler(CookingworkshopSpider, settings)
+        self.crawler.spider = create_spider()
+        # The download slot of the site, as the downloader keeps it
+        self.slot = SimpleNamespace(delay=1)
+        self.crawler.engine = SimpleNamespace(downloader=SimpleNamespace(
+            slots={'www.cheftayebeh.ir': self.slot}))
+        self.middleware = BackoffRetryMiddleware.from_crawler(self.crawler)
+
+    def request(self):
+        return Request('http://www.cheftayebeh.ir/feeds/posts/summary',
+                       meta={'download_slot': 'www.cheftayebeh.ir'})
+
+    def test_growing_delay(self):
+        request = self.request()
+        delays = []
+        for status in (429, 503, 429):
+            request = self.middleware.process_response(
+                request, Response(request.url, status=status))
+            self.assertIsInstance(request, Request)
+            delays.append(self.slot.delay)
+        # RETRY_BACKOFF_BASE of the polite profile is 2 seconds
+        self.assertEqual(delays, [2, 4, 8])
+        self.assertEqual(request.meta['retry_times'], 3)
+
+    def test_retry_after(self):
+        response = Response(self.request().url, status=503,
+                            headers={'Retry-After': '30'})
+        self.middleware.process_response(self.request(), response)
+        self.assertEqual(self.slot.delay, 30)
+        response.headers['Retry-After'] = '3600'
+        self.middleware.process_response(self.request(), response)
+        self.assertEqual(self.slot.delay, PROFILES['polite']['RETRY_BACKOFF_MAX'])
+
+    def test_not_retried(self):
+        response = Response(self.request().url, status=404)
+        self.assertIs(self.middleware.process_response(self.request(), response),
+                      response)
+        self.assertEqual(self.slot.delay, 1)
+
+    def test_exception(self):
+        request = self.middleware.process_exception(self.request(), TimeoutError())
+        self.assertIsInstance(request, Request)
+        self.assertEqual(self.slot.delay, 2)
+
+    def fine_response(self):
+        # a fine response of another request of the slot
+        request = self.request()
+        request.meta['download_latency'] = 0
+        self.crawler.signals.send_catch_log(
+            signals.response_downloaded, response=Response(request.url, status=200),
+            request=request, spider=self.crawler.spider)
+
+    def check_autothrottle(self, extension):
+        self.crawler.signals.disconnect_all(signals.response_downloaded)
+        # the signals keep weak references to their receivers
+        self.extension = extension.from_crawler(self.crawler)
+        self.crawler.signals.send_catch_log(signals.spider_opened,
+                                            spider=self.crawler.spider)
+        request = self.request()
+        delays = []
+        for status in (503, 200, 503, 200):
+            if status == 200:
+                self.fine_response()
+            else:
+                request = self.middleware.process_response(
+                    request, Response(request.url, status=status))
+            delays.append(self.slot.delay)
+        return delays
+
+    def test_autothrottle(self):
+        # AutoThrottle lowers the delay before the retry is sent
+        self.assertEqual(self.check_autothrottle(AutoThrottle), [2, 1, 4, 2])
+
+    def test_backoff_autothrottle(self):
+        # the second 503 delays its retry by 4 seconds
+        self.assertEqual(self.check_autothrottle(BackoffAutoThrottle), [2, 2, 4, 4])
+        # then AutoThrottle adjusts the delay again
+        self.slot.backoff_until = 0
+        self.fine_response()
+        self.assertEqual(self.slot.delay, 2)
+
+
+class ProfilesTest(SimpleTestCase):
+
+    def test_profiles(self):
+        settings = Settings()
+        apply_profile(settings)
+        self.assertEqual(settings.getint('CONCURRENT_REQUESTS'), 4)
+        self.assertEqual(settings.getdict('DOWNLOADER_MIDDLEWARES'), {
+            'scrapy.downloadermiddlewares.retry.RetryMiddleware': None,
+            'scrapy_app.middlewares.BackoffRetryMiddleware': 550,
+        })
+        self.assertEqual(settings.getdict('EXTENSIONS'), {
+            'scrapy.extensions.throttle.AutoThrottle': None,
+            'scrapy_app.extensions.BackoffAutoThrottle': 0,
+        })
+
+        # settings of the command line win over the profile
+        settings = Settings()
+        settings.set('CRAWL_PROFILE', 'fast', priority='cmdline')
+        settings.set('CONCURRENT_REQUESTS', 8, priority='cmdline')
+        apply_profile(settings)
+        self.assertEqual(settings.getint('CONCURRENT_REQUESTS'), 8)
+        self.assertEqual(settings.getint('CONCURRENT_REQUESTS_PER_DOMAIN'), 16)
+
+        settings = Settings({'CRAWL_PROFILE': 'fastest'})
+        with self.assertRaises(ValueError):
+            apply_profile(settings)